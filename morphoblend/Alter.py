@@ -2,9 +2,11 @@ import re
 
 import bmesh
 import bpy
+import numpy as np
 
-from .Quantify import volume_and_area_from_object
-from .Utilities import (ObjectNavigator, apply_modifiers)
+from .Quantify import volumes_and_areas_from_objects
+from .Utilities import (ObjectNavigator, apply_modifiers, g_cell_id_attribute, get_collection, is_packed, pack_objects, packed_object,
+                        unpack_cells)
 
 # ------------------------------------------------------------------------
 #    Keymaps
@@ -159,13 +161,8 @@ class MORPHOBLEND_OT_Merge(bpy.types.Operator):
 
     def execute(self, context):
         # Estimate the size of each object and make sure it is the 'master'
-        names_array = []
-        vol_array = []
-        for obj in bpy.context.selected_objects:
-            bpy.context.view_layer.objects.active = obj
-            names_array.append(obj.name)
-            vol, area = volume_and_area_from_object(obj)
-            vol_array.append(vol)
+        names_array = [obj.name for obj in bpy.context.selected_objects]
+        vol_array = [vol for vol, area in volumes_and_areas_from_objects(bpy.context.selected_objects)]
         biggest_name = names_array[vol_array.index(max(vol_array))]
         biggest_ob = bpy.context.scene.objects[biggest_name]
         bpy.context.view_layer.objects.active = biggest_ob
@@ -275,6 +272,69 @@ class MORPHOBLEND_OT_Split_finish(bpy.types.Operator):
         return {'FINISHED'}
 
 
+class MORPHOBLEND_OT_Unpack(bpy.types.Operator):
+    '''Turn cells of a packed time point back into objects to edit them. In Edit mode, the cells with selected faces; otherwise all cells.'''
+    bl_idname = 'morphoblend.unpack'
+    bl_label = 'Unpack'
+    bl_descripton = 'Turn cells of a packed time point back into objects.'
+    bl_options = {'REGISTER', 'UNDO', 'INTERNAL'}
+
+    @classmethod
+    def poll(cls, context):
+        return is_packed(context.active_object)
+
+    def execute(self, context):
+        packed = context.active_object
+        cell_ids = None
+        if packed.mode == 'EDIT':
+            # Selection is written to the mesh when leaving Edit mode
+            bpy.ops.object.mode_set(mode='OBJECT')
+            selected = np.empty(len(packed.data.polygons), dtype=bool)
+            packed.data.polygons.foreach_get('select', selected)
+            ids = np.empty(len(packed.data.polygons), dtype=np.int32)
+            packed.data.attributes[g_cell_id_attribute].data.foreach_get('value', ids)
+            cell_ids = [int(cell_id) for cell_id in np.unique(ids[selected])]
+            if not cell_ids:
+                self.report({'WARNING'}, 'No face selected')
+                return {'CANCELLED'}
+        cells = unpack_cells(packed, cell_ids)
+        bpy.ops.object.select_all(action='DESELECT')
+        for obj in cells:
+            obj.select_set(True)
+        if cells:
+            context.view_layer.objects.active = cells[0]
+        self.report({'INFO'}, f"{len(cells)} cell(s) unpacked")
+        return {'FINISHED'}
+
+
+class MORPHOBLEND_OT_Pack(bpy.types.Operator):
+    '''Pack the selected cells into the single mesh of their time point (created if needed)'''
+    bl_idname = 'morphoblend.pack'
+    bl_label = 'Pack'
+    bl_descripton = 'Pack the selected cells into the single mesh of their time point.'
+    bl_options = {'REGISTER', 'UNDO', 'INTERNAL'}
+
+    @classmethod
+    def poll(cls, context):
+        return context.mode == 'OBJECT' and any(obj.type == 'MESH' and not is_packed(obj) for obj in context.selected_objects)
+
+    def execute(self, context):
+        # Group the cells per time point (collection)
+        cells_per_coll = {}
+        for obj in context.selected_objects:
+            if obj.type == 'MESH' and not is_packed(obj):
+                cells_per_coll.setdefault(get_collection(obj).name, []).append(obj)
+        n_cells = 0
+        for coll_name, cells in cells_per_coll.items():
+            coll = bpy.data.collections.get(coll_name, context.scene.collection)
+            n_cells += len(cells)
+            packed = pack_objects(cells, packed_object(coll), f"{coll_name}_packed")
+        context.view_layer.objects.active = packed
+        packed.select_set(True)
+        self.report({'INFO'}, f"{n_cells} cell(s) packed")
+        return {'FINISHED'}
+
+
 # ------------------------------------------------------------------------
 #    UI elements
 # ------------------------------------------------------------------------
@@ -324,6 +384,13 @@ class MORPHOBLEND_PT_Alter(bpy.types.Panel):
         row.operator(MORPHOBLEND_OT_Split.bl_idname, text='Start Split')
         row.operator(MORPHOBLEND_OT_Split_finish.bl_idname, text='Finish Split')
 
+        box = layout.box()
+        row = box.row()
+        row.label(text='Packed time points', icon='MOD_EXPLODE')
+        row = box.row()
+        row.operator(MORPHOBLEND_OT_Unpack.bl_idname, text='Unpack')
+        row.operator(MORPHOBLEND_OT_Pack.bl_idname, text='Pack')
+
 
 # ------------------------------------------------------------------------
 #    Registrer/unregister calls
@@ -334,7 +401,9 @@ MORPHOBLEND_OT_WorkListNext,
 MORPHOBLEND_OT_WorkListPrevious,
 MORPHOBLEND_OT_Merge,
 MORPHOBLEND_OT_Split,
-MORPHOBLEND_OT_Split_finish,)
+MORPHOBLEND_OT_Split_finish,
+MORPHOBLEND_OT_Unpack,
+MORPHOBLEND_OT_Pack,)
 
 register_classes, unregister_classes = bpy.utils.register_classes_factory(classes)
 
@@ -1,7 +1,6 @@
 import json
 import re
 import csv
-from itertools import combinations
 from math import acos, radians
 from pathlib import Path
 from random import randrange
@@ -10,7 +9,6 @@ from mathutils import Matrix
 import mathutils
 from math import acos, pi
 
-import bmesh
 import bpy
 import networkx as nx
 from anytree import (AsciiStyle, Node, PreOrderIter, RenderTree, find_by_attr,
@@ -22,7 +20,6 @@ from bpy.props import (BoolProperty, BoolVectorProperty, EnumProperty,
                        StringProperty, CollectionProperty)
 from bpy_extras.view3d_utils import region_2d_to_location_3d
 from mathutils import Vector
-from mathutils.bvhtree import BVHTree
 from networkx.readwrite import json_graph
 
 from .Utilities import *
@@ -412,9 +409,19 @@ class MORPHOBLEND_OT_Lineages_Create(bpy.types.Operator):
         analyze_op = context.scene.analyze_tool
         _apply_to_all = analyze_op.bool_track_all
         _threshold_child = analyze_op.threshold_tracking
+        # Time points tracked: all of them, or from the one of the selected cells
+        all_tp_cols = collections_from_pattern(analyze_op.tp_pattern)
+        if not _apply_to_all:
+            # Retrieve the currently active time point
+            currentTP = show_active_tp(context)
+            # Remove from the list all time points anterior to this one
+            del all_tp_cols[:all_tp_cols.index(currentTP)]
+        # Packed cells are not objects: they cannot be tracked
+        packed = packed_collections(all_tp_cols)
+        if packed:
+            self.report({'ERROR'}, f"Packed time points ({', '.join(packed)}): unpack them (Alter) before tracking cells")
+            return {'CANCELLED'}
         if _apply_to_all:  # Process all objects starting from the first time point
-            # Get all TP collections
-            all_tp_cols = collections_from_pattern(analyze_op.tp_pattern)
             # Iterate over all time points
             for prev, item, nxt in previous_and_next(all_tp_cols):
                 for obj in item.all_objects:  # Process all objects of the collection
@@ -431,12 +438,6 @@ class MORPHOBLEND_OT_Lineages_Create(bpy.types.Operator):
             for obj in bpy.context.selected_objects:
                 if obj.type == 'MESH':
                     g_lineages[obj.name] = Node(name=obj.name, obj_name=obj.name)
-            # Get all TP collections
-            all_tp_cols = collections_from_pattern(analyze_op.tp_pattern)
-            # Retrieve the currently active time point
-            currentTP = show_active_tp(context)
-            # Remove from the list all time points anterior to this one
-            del all_tp_cols[:all_tp_cols.index(currentTP)]
             # Iterate over all remaining time points
             for prev, item, nxt in previous_and_next(all_tp_cols):
                 for obj in item.all_objects:
@@ -458,17 +459,12 @@ class MORPHOBLEND_OT_Lineages_Create(bpy.types.Operator):
 
     def child_in_next_tp(self, nxt, pos_obj, _threshold_child, obj):
         ''' Identifies child of an object in the next collection and add it to the lineage tree.'''
-        d_objn = {}  # Dict storing the name and distances between the reference object and each object in the next time point
-        # compute distance between the object and *all* objects in the next time point
-        for obj_n in nxt.all_objects:
-            pos_obj_n = get_global_coordinates(obj_n)
-            d_objn[obj_n] = distance3D(pos_obj, pos_obj_n)
-        # Get the closest object
-        closest = min(d_objn, key=d_objn.get)
-        if d_objn[closest] < _threshold_child:
+        # Closest cell of the next time point, from the centers of all its cells at once
+        closest, distance = cell_registry().nearest(nxt.name, pos_obj)
+        if closest is not None and distance < _threshold_child:
             # if distance to the closest is inf to the user defined threshold, define the object as a valid child
             for root, tree in g_lineages.items():
-                Node(name=closest.name, obj_name=closest.name, parent=find_by_attr(tree, obj.name))
+                Node(name=closest, obj_name=closest, parent=find_by_attr(tree, obj.name))
 
 
 class MORPHOBLEND_OT_Lineages_Clear(bpy.types.Operator):
@@ -643,36 +639,47 @@ class MORPHOBLEND_OT_3DConnectivity_Create(bpy.types.Operator):
         if _apply_to_all: 
             # Get all TP collections
             all_tp_cols = collections_from_pattern(analyze_op.tp_pattern)
+            # Pairs of cells (objects or cells of the packed objects) close enough to touch (overlapping bounding boxes)
+            tp_pairs = {tp.name: contact_candidates(tp.all_objects) for tp in all_tp_cols}
             # Get the total number of pairs to be analyzed
-            total_n_pairs = self.get_number_of_pairs(all_tp_cols)
+            total_n_pairs = sum(len(pairs) for pairs in tp_pairs.values())
             # Iterate over all time points
             for tp in all_tp_cols:
                 tp_G = nx.Graph()
-                # Get all unique pairs of two objects and check if they are touching
-                print(f"Extracting 3D connectivity for {tp.name}: processing {len(list(combinations(tp.all_objects, 2)))} pairs...")
-                for objpair in combinations(tp.all_objects, 2):
-                    area_intersection = self.intersection_area(objpair[0], objpair[1])
+                # Geometry of each cell of the time point, built once for all its pairs
+                geometry = ContactGeometry()
+                # Check if the candidate pairs of objects are touching
+                print(f"Extracting 3D connectivity for {tp.name}: processing {len(tp_pairs[tp.name])} pairs...")
+                areas = geometry.intersection_areas(tp_pairs[tp.name])
+                for objpair, area_intersection in zip(tp_pairs[tp.name], areas):
                     if area_intersection != 0:
                         # Add the pair of objects (referenced by name) as a weighted edge to the graph
-                        self.add_edge(tp_G, objpair, area_intersection)
-                    pairs_processed += 1
+                        add_contact_edge(tp_G, objpair, area_intersection)
+                pairs_processed += len(tp_pairs[tp.name])
+                geometry.clear()
+                # Geometry of the cells when the graph is built, to refresh it after edits
+                tp_G.graph['fingerprints'] = cell_digests(contact_cells(tp.all_objects))
                 # add the Graph to the dict
                 self.update_progress(context, pairs_processed, total_n_pairs)
                 g_networks[tp.name] = tp_G
         else:
             # Get current time point
             currentTP = show_active_tp(context)
+            # Pairs of selected cells close enough to touch (overlapping bounding boxes)
+            pairs = contact_candidates(bpy.context.selected_objects)
             # Get the total number of pairs to be analyzed
-            total_n_pairs = self.get_number_of_pairs(currentTP)
+            total_n_pairs = len(pairs)
             G = nx.Graph()
-            print(f"Processing {len(list(combinations(currentTP.all_objects, 2)))} pairs...")
-            for objpair in combinations(bpy.context.selected_objects, 2):
-                area_intersection = self.intersection_area(objpair[0], objpair[1])
+            geometry = ContactGeometry()
+            print(f"Processing {total_n_pairs} pairs...")
+            for objpair, area_intersection in zip(pairs, geometry.intersection_areas(pairs)):
                 if area_intersection != 0:
                     # Add the pair of objects (referenced by name) as a weighted edge to the graph
-                    self.add_edge(G, objpair, area_intersection)
-                pairs_processed += 1
-                self.update_progress(context, pairs_processed, total_n_pairs)
+                    add_contact_edge(G, objpair, area_intersection)
+            self.update_progress(context, total_n_pairs, total_n_pairs)
+            geometry.clear()
+            G.graph['fingerprints'] = cell_digests(contact_cells(bpy.context.selected_objects))
+            G.graph['selection'] = True
             g_networks[currentTP.name] = G
         # Store data:
         store_3dConnectivity(g_networks)
@@ -682,57 +689,58 @@ class MORPHOBLEND_OT_3DConnectivity_Create(bpy.types.Operator):
         self.report({'INFO'}, 'Done!')
         return {'FINISHED'}
 
-    def add_edge(self, tp_G, objpair, area_intersection):
-        # Add the pair of objects (referenced by name) as a weighted edge to the graph
-        tp_G.add_edge(objpair[0].name, objpair[1].name, area=area_intersection)
-        # Add to the nodes the collection/tissue of the cell
-        tp_G.nodes[objpair[0].name]['collection'] = get_collection(objpair[0]).name
-        tp_G.nodes[objpair[1].name]['collection'] = get_collection(objpair[1]).name
-
-    def get_number_of_pairs(self, inSet):
-        total = 0
-        try:
-            for e in inSet:
-                total += len(list(combinations(e.all_objects, 2)))
-        except TypeError as te:
-            total =  len(list(combinations(inSet.all_objects, 2)))
-        return total
-
     def update_progress(self, context, n_file, total):
         analyze_op = context.scene.analyze_tool
-        progress_ratio = n_file / total * 100
+        progress_ratio = n_file / max(total, 1) * 100
         analyze_op.progress_bar = progress_ratio
         bpy.ops.wm.redraw_timer(type='DRAW_WIN_SWAP', iterations=1)
 
-    def intersection_area(self, obj1, obj2):
-        '''If two objects intersect, return the scaled area of contact or 0 if no intersection. The area is the average of the areas for each object'''
-        # Create two empty bmesh and fill with data from objects
-        bm1 = bmesh.new()
-        bm2 = bmesh.new()
-        bm1 = bmesh_copy_from_object(obj1, apply_modifiers=True)
-        bm2 = bmesh_copy_from_object(obj2, apply_modifiers=True)
-
-        # make BVH tree from BMesh of objects
-        obj1_BVHtree = BVHTree.FromBMesh(bm1)
-        obj2_BVHtree = BVHTree.FromBMesh(bm2)
-
-        # get intersecting pairs of faces indices
-        inter = obj1_BVHtree.overlap(obj2_BVHtree)
-
-        # if list is not empty,  objects are touching, compute the scaled area of contact as average of area on each object
-        if inter != []:
-            obj1_faces_idx = set([i[0] for i in inter])
-            obj2_faces_idx = set([i[1] for i in inter])
-            return (self.area_faces(bm1, obj1_faces_idx) + self.area_faces(bm2, obj2_faces_idx)) / 2
-        else:
-            return 0
 
-    def area_faces(self, bm, idx_faces):
-        ''' Return the scaled area of the a set of faces defined by their  indices'''
-        bm.faces.ensure_lookup_table()
-        area = sum(bm.faces[idx].calc_area() for idx in idx_faces)
-        scaled_area = area * bpy.context.scene.unit_settings.scale_length ** 2
-        return scaled_area
+class MORPHOBLEND_OT_3DConnectivity_Refresh(bpy.types.Operator):
+    ''' Update the 3D connectivity graphs after cells were edited (merged, split, deleted...)'''
+    bl_idname = 'morphoblend.refresh_networks'
+    bl_label = 'Refresh networks'
+    bl_descripton = 'Recompute the contacts of the cells edited since the graphs were built'
+
+    @classmethod
+    def poll(cls, context):
+        return len(g_networks) > 0
+
+    def execute(self, context):
+        n_changed = 0
+        n_graphs = 0
+        for tp_name, G in g_networks.items():
+            tp = bpy.data.collections.get(tp_name)
+            if tp is None:
+                continue
+            fingerprints = G.graph.get('fingerprints', {})
+            # Objects and cells of the packed objects
+            cells = contact_cells(tp.all_objects)
+            if G.graph.get('selection'):
+                # Graph of a selection: only the cells it was built from
+                cells = [cell for cell in cells if cell.name in fingerprints]
+            current = cell_digests(cells)
+            # Cells edited or added since the graph was built (all of them if it was built without fingerprints), and removed
+            changed = {name for name, digest in current.items() if fingerprints.get(name) != digest}
+            removed = set(fingerprints) - set(current)
+            if not changed and not removed:
+                continue
+            # Drop the edges of these cells, then test them again against their spatial neighbours
+            G.remove_nodes_from([name for name in changed | removed if name in G])
+            pairs = [objpair for objpair in contact_candidates(cells) if objpair[0].name in changed or objpair[1].name in changed]
+            print(f"Refreshing 3D connectivity for {tp_name}: {len(changed)} changed and {len(removed)} removed cells, {len(pairs)} pairs...")
+            geometry = ContactGeometry()
+            for objpair, area_intersection in zip(pairs, geometry.intersection_areas(pairs)):
+                if area_intersection != 0:
+                    add_contact_edge(G, objpair, area_intersection)
+            geometry.clear()
+            G.graph['fingerprints'] = current
+            n_changed += len(changed) + len(removed)
+            n_graphs += 1
+        if n_graphs:
+            store_3dConnectivity(g_networks)
+        self.report({'INFO'}, f"{n_changed} cell(s) updated in {n_graphs} graph(s)")
+        return {'FINISHED'}
 
 
 class MORPHOBLEND_OT_3DConnectivity_Load(bpy.types.Operator):
@@ -795,9 +803,18 @@ class MORPHOBLEND_OT_3DConnectivity_Draw(bpy.types.Operator):
         for tp, G in g_networks.items():
             # Create sub-collection for Graph
             subcol = make_collection("3dConnectivity", bpy.data.collections[tp])
+            # Location and material of each cell: the object, or the center of a cell of a packed object
+            places = {}
+            for obj in bpy.data.collections[tp].all_objects:
+                if is_packed(obj):
+                    places.update(packed_cell_places(obj))
+            for node in G.nodes():
+                if node not in places:
+                    node_obj = bpy.data.objects[node]
+                    places[node] = (node_obj.location, node_obj.active_material)
             # Draw each Nodes and edges
-            self.draw_Nodes(G, subcol)
-            self.draw_Edges(G, subcol)
+            self.draw_Nodes(G, subcol, places)
+            self.draw_Edges(G, subcol, places)
         # Smooth and join them
         # FIXME: below --> only smooth the first set & returns an error after erasing
         # self.smooth_join(context)
@@ -806,29 +823,24 @@ class MORPHOBLEND_OT_3DConnectivity_Draw(bpy.types.Operator):
         self.report({'INFO'}, 'Done!')
         return {'FINISHED'}
 
-    def draw_Nodes(self, G, DestColl):
+    def draw_Nodes(self, G, DestColl, places):
         for node in G.nodes():
             # Create an empty mesh and the object.
             bpy.ops.object.select_all(action='DESELECT')
             bpy.ops.mesh.primitive_uv_sphere_add()
             node_sphere = bpy.context.object
             # Set  its properties from the ones referenced as node
-            node_obj = bpy.data.objects[node]
-            node_sphere.location = node_obj.location
+            node_sphere.location, node_sphere.active_material = places[node]
             node_sphere.name = "node_" + node
             node_sphere.dimensions = [0.25, 0.25, 0.25]
-            node_sphere.active_material = node_obj.active_material
             move_obj_to_coll(node_sphere, DestColl)
             self.shapes.append(node_sphere)
 
-    def draw_Edges(self, G, DestColl):
+    def draw_Edges(self, G, DestColl, places):
         for source, target in G.edges():
-            # Get references to the objects forming the edge
-            source_obj = bpy.data.objects[source]
-            target_obj = bpy.data.objects[target]
             # Get location of neighbour cells
-            source_loc = source_obj.location
-            target_loc = target_obj.location
+            source_loc = places[source][0]
+            target_loc = places[target][0]
             # compute difference, center and mag (??)
             diff = [c2 - c1 for c2, c1 in zip(source_loc, target_loc)]
             cent = [(c2 + c1) / 2 for c2, c1 in zip(source_loc, target_loc)]
@@ -1222,12 +1234,24 @@ def showSubCol(context, pattern):
     return None
 
 
+def add_contact_edge(tp_G, objpair, area_intersection):
+    # Add the pair of objects (referenced by name) as a weighted edge to the graph
+    tp_G.add_edge(objpair[0].name, objpair[1].name, area=area_intersection)
+    # Add to the nodes the collection/tissue of the cell
+    tp_G.nodes[objpair[0].name]['collection'] = get_collection(objpair[0]).name
+    tp_G.nodes[objpair[1].name]['collection'] = get_collection(objpair[1]).name
+
+
 def store_3dConnectivity(connectivity):
     if connectivity is not None:
+        # Replace the graphs already stored for a time point
+        stored = {item.key: item for item in bpy.context.scene.g_networks}
         for tp, G in connectivity.items():
             data = json_graph.node_link_data(G)
-            item = bpy.context.scene.g_networks.add()
-            item.key = tp
+            item = stored.get(tp)
+            if item is None:
+                item = bpy.context.scene.g_networks.add()
+                item.key = tp
             item.value = json.dumps(data)
 
 
@@ -1344,6 +1368,7 @@ class MORPHOBLEND_PT_Analyze(bpy.types.Panel):
         row = box.row()
         row.prop(analyze_op, "bool_3dconnect_all")
         row.operator(MORPHOBLEND_OT_3DConnectivity_Create.bl_idname, text='Generate', icon='OUTLINER_DATA_MESH')
+        row.operator(MORPHOBLEND_OT_3DConnectivity_Refresh.bl_idname, text='Refresh', icon='FILE_REFRESH')
         row.operator(MORPHOBLEND_OT_3DConnectivity_Load.bl_idname, text='Load', icon='ADD')
         row.operator(MORPHOBLEND_OT_3DConnectivity_Clear.bl_idname, text='Clear', icon='X')
 
@@ -1406,6 +1431,7 @@ render_classes = (AnalyzeProperties,
     # MORPHOBLEND_OT_Lineages_Export,
     # MORPHOBLEND_OT_Lineages_Load,
     MORPHOBLEND_OT_3DConnectivity_Create,
+    MORPHOBLEND_OT_3DConnectivity_Refresh,
     MORPHOBLEND_OT_3DConnectivity_Load,
     MORPHOBLEND_OT_3DConnectivity_Clear,
     MORPHOBLEND_OT_3DConnectivity_Draw,
@@ -1,85 +1,468 @@
-from math import radians
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from math import radians, sqrt
 from pathlib import Path
 
 import bpy
-from bpy.props import (FloatProperty,
+import numpy as np
+from bpy.props import (BoolProperty, EnumProperty, FloatProperty,
                        FloatVectorProperty, IntProperty, IntVectorProperty,
                        PointerProperty, StringProperty)
-from mathutils import Matrix
+from mathutils import Matrix, Vector
 
-from .Utilities import (apply_modifiers, assign_material, create_materials_palette, translate_to_origin, number_of_file_to_import)
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from .Mesh_io import (DigestIndex, cached_mesh_path, free_shared_array, g_label_extensions, label_bounding_boxes, load_cached_mesh, mesh_label,
+                      mesh_label_to_shared_memory, parse_to_shared_memory, read_and_center, read_label_volume, read_mesh_counts, read_shared_array,
+                      rotation_scaling_matrix, save_cached_mesh, set_label_volume, surface_area, transform_and_center)
+from .Utilities import (apply_modifiers, assign_material, create_materials_palette, translate_to_origin, scan_mesh_files,
+                        is_packed, pack_objects, packed_cell_names, packed_object, remove_packed_cells,
+                        mesh_dimensions, mesh_to_arrays, mesh_to_polygon_arrays, object_from_arrays)
 
 # ------------------------------------------------------------------------
 #    Global variables
 # ------------------------------------------------------------------------
-g_allowed_extension = ('.obj', '.OBJ', '.ply', '.PLY')
+# Extensions of the files to import (case-insensitive)
+g_allowed_extension = ('.obj', '.ply')
+# Name of the scene property storing which files have been imported
+g_manifest_key = 'morphoblend_import_manifest'
+# Digests of the content of the files, keys of the cache of processed meshes (None when there is no cache)
+g_digest_index = None
+# Smoothing: octree depth of the Remesh for small and large objects, size separating them and ratio of the Decimate
+g_remesh_depths = (6, 7)
+g_remesh_size_threshold = 2.5
+g_decimate_ratio = 0.5
+# Face budget: octree depths allowed, scale of the Remesh (Blender's default) and minimum number of triangles per cell
+g_remesh_depth_range = (3, 10)
+g_remesh_scale = 0.9
+g_min_triangles = 200
+# Measurements of each imported file (wall time per stage of the main thread in s, time spent reading in a worker, size before/after smoothing, peak memory), see write_import_report()
+g_import_stats = []
+g_report_stages = ('cache_load', 'parse', 'read', 'transform', 'create', 'remesh', 'decimate', 'material', 'cache_save', 'link')
+g_report_fields = ('file', 'cached', *g_report_stages, 'total', 'parse_worker', 'verts_in', 'faces_in', 'verts_out', 'faces_out', 'peak_memory_mb')
 
 # ------------------------------------------------------------------------
 #    Functions
 # ------------------------------------------------------------------------
 
 
-def import_process_assign(inColl=None, inFilePath=''):
-    '''Import, process and assign all mesh files into collections'''
-    if (inFilePath.endswith('.ply') | inFilePath.endswith('.PLY')):
-        bpy.ops.import_mesh.ply(filepath=inFilePath)
-    elif (inFilePath.endswith('.obj') | inFilePath.endswith('.OBJ')):
-        bpy.ops.import_scene.obj(filepath=inFilePath)
-    # Scale, move, smooth and colorize
-    obj = bpy.context.active_object
-    obj = scale_rotate(obj, inAngles=(radians(g_rot_val_x), radians(g_rot_val_y), radians(g_rot_val_z)), inScaling=(g_scaling_x, g_scaling_y, g_scaling_z))
-    obj = smooth_color(obj)
-    # Prefix the object name with the collection
-    obj.name = f"{inColl.name}_{obj.name}"
-    # Move the object to the collection
-    if obj.name not in bpy.data.collections[inColl.name].objects:
-        inColl.objects.link(obj)
-        bpy.data.collections[g_import_coll_name].objects.unlink(obj)
-
-def smooth_color(inObj):
-    '''Apply material and smoothing modifiers to an object'''
-    # Degree of smoothing depends on the dimensions of the object: large objects --> higher octree_factor --> more details
-    # this is arbitrary (and in internal Blender units - NO scaling applied)
-    # TODO  come up with a smarter way
-    dims = inObj.dimensions
-    if max(dims) > 2.5:
-        octree_factor = 7
+def import_process_assign(inColl=None, inFilePath='', inArrays=None, inName=None):
+    '''Import, process and assign all mesh files into collections.
+    inArrays are the (vertices, faces, center, time spent reading) of the file already read, rotated, scaled and centered by a worker process.
+    inName is the name of the object, by default the name of the file: cells meshed from a label volume are named after their label
+    (and are not cached). The time spent in each stage is recorded in g_import_stats.'''
+    record = {'file': inFilePath if inName is None else f"{inFilePath}:{inName}", 'cached': False}
+    start = time.perf_counter()
+    # Reuse the result of a previous import of the same file with the same settings
+    with timed(record, 'cache_load'):
+        cache_path = None
+        if g_cache_dir and inName is None:
+            # Known unless the file was read on this thread: hashed now
+            cache_path = cached_mesh_path(g_cache_dir, g_digest_index.digest(inFilePath), smoothing_signature())
+        cached = load_cached_mesh(cache_path) if cache_path is not None and cache_path.exists() else None
+    if cached is not None:
+        record['cached'] = True
+        with timed(record, 'create'):
+            obj = object_from_arrays(Path(inFilePath).stem, cached['verts'], cached['loops'], cached['face_sizes'], cached['use_smooth'])
+            obj.location = cached['center']
+        with timed(record, 'link'):
+            inColl.objects.link(obj)
+        with timed(record, 'material'):
+            assign_material(obj, g_mat_palette, rand_color=True)
+        obj.name = f"{inColl.name}_{obj.name}"
+        record['verts_out'], record['faces_out'] = len(obj.data.vertices), len(obj.data.polygons)
+        finish_record(record, start)
+        return obj
+    if inArrays is None and g_native_reader:
+        with timed(record, 'parse'):
+            inArrays = (*read_and_center(inFilePath, import_matrix()), 0.0)
+    if inArrays is not None:
+        # Read by a worker process, in parallel: not part of the time spent on the main thread
+        record['parse_worker'] = inArrays[3]
+        with timed(record, 'create'):
+            obj = import_native(inFilePath, inColl, inArrays, inName)
     else:
-        octree_factor = 6
-    remesh = inObj.modifiers.new(name='Remesh', type='REMESH')
-    remesh.octree_depth = octree_factor
-    remesh.use_smooth_shade = True
-    remesh.mode = 'SMOOTH'
-    decim = inObj.modifiers.new(name='Decimate', type='DECIMATE')
-    decim.ratio = 0.5
-    inObj = apply_modifiers(inObj)
+        with timed(record, 'read'):
+            extension = Path(inFilePath).suffix.lower()
+            if extension == '.ply':
+                bpy.ops.import_mesh.ply(filepath=inFilePath)
+            elif extension == '.obj':
+                bpy.ops.import_scene.obj(filepath=inFilePath)
+            obj = bpy.context.active_object
+        # Scale, move
+        with timed(record, 'transform'):
+            obj = scale_rotate(obj, inAngles=(radians(g_rot_val_x), radians(g_rot_val_y), radians(g_rot_val_z)), inScaling=(g_scaling_x, g_scaling_y, g_scaling_z))
+    record['verts_in'], record['faces_in'] = len(obj.data.vertices), len(obj.data.polygons)
+    # Smooth and colorize
+    obj = smooth_color(obj, record)
+    record['verts_out'], record['faces_out'] = len(obj.data.vertices), len(obj.data.polygons)
+    if cache_path is not None:
+        with timed(record, 'cache_save'):
+            verts, loops, face_sizes, use_smooth = mesh_to_polygon_arrays(obj.data)
+            save_cached_mesh(cache_path, verts=verts, loops=loops, face_sizes=face_sizes, use_smooth=use_smooth, center=np.array(obj.location))
+    with timed(record, 'link'):
+        # Prefix the object name with the collection
+        obj.name = f"{inColl.name}_{obj.name}"
+        # Move the object to the collection
+        if obj.name not in bpy.data.collections[inColl.name].objects:
+            inColl.objects.link(obj)
+            bpy.data.collections[g_import_coll_name].objects.unlink(obj)
+    finish_record(record, start)
+    return obj
+
+
+def import_native(inFilePath, inColl, inArrays, inName=None):
+    '''Create the object directly from the arrays (vertices, faces, center, ...) read with the built-in reader and link it to the collection'''
+    verts, faces, center = inArrays[:3]
+    obj = object_from_arrays(Path(inFilePath).stem if inName is None else inName, verts, faces)
+    obj.location = center
+    inColl.objects.link(obj)
+    return obj
+
+
+# ------------------------------------------------------------------------
+#    Instrumentation
+# ------------------------------------------------------------------------
+@contextmanager
+def timed(inRecord, inStage):
+    '''Add the wall time spent in the block to a stage of the record of a file'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        inRecord[inStage] = inRecord.get(inStage, 0.0) + time.perf_counter() - start
+
+
+def finish_record(inRecord, inStart):
+    '''Complete the record of a file with the total time and peak memory and store it'''
+    inRecord['total'] = time.perf_counter() - inStart
+    inRecord['peak_memory_mb'] = peak_memory_mb()
+    g_import_stats.append(inRecord)
+
+
+def peak_memory_mb():
+    '''Peak resident memory of this process in MB (None where not available). Memory used by the worker processes is not included'''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kB on Linux
+    return round(peak / (1 << 20) if sys.platform == 'darwin' else peak / 1024, 1)
+
+
+def import_report_summary():
+    '''Return the lines summarising g_import_stats: total, share and mean time per cell of each stage of the main thread'''
+    n_files = len(g_import_stats)
+    if n_files == 0:
+        return ['No file imported']
+    total = sum(r['total'] for r in g_import_stats)
+    n_cached = sum(r['cached'] for r in g_import_stats)
+    lines = [f"{n_files} files imported ({n_cached} from the cache) in {total:.1f}s - {1000 * total / n_files:.1f}ms per cell"]
+    for stage in g_report_stages:
+        stage_total = sum(r.get(stage, 0.0) for r in g_import_stats)
+        if stage_total > 0:
+            lines.append(f"  {stage:<10} {stage_total:9.2f}s {100 * stage_total / max(total, 1e-9):5.1f}% {1000 * stage_total / n_files:9.2f}ms per cell")
+    parse_worker = sum(r.get('parse_worker', 0.0) for r in g_import_stats)
+    if parse_worker > 0:
+        lines.append(f"  {'parse':<10} {parse_worker:9.2f}s in the worker processes")
+    faces_in = sum(r.get('faces_in', 0) for r in g_import_stats)
+    faces_out = sum(r.get('faces_out', 0) for r in g_import_stats)
+    lines.append(f"  faces: {faces_in} before smoothing, {faces_out} after")
+    peaks = [r['peak_memory_mb'] for r in g_import_stats if r.get('peak_memory_mb') is not None]
+    if peaks:
+        lines.append(f"  peak memory: {max(peaks)} MB")
+    return lines
+
+
+def write_import_report(inBasePath):
+    '''Write g_import_stats next to inBasePath: one row per file in <inBasePath>_timings.csv, the same plus the summary in <inBasePath>_timings.json'''
+    base_path = Path(inBasePath)
+    base_path = base_path.with_name(f"{base_path.stem}_timings")
+    with open(base_path.with_suffix('.json'), 'w', encoding='utf-8') as f:
+        json.dump({'summary': import_report_summary(), 'files': g_import_stats}, f, indent=1)
+    with open(base_path.with_suffix('.csv'), 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=g_report_fields, restval=0.0)
+        writer.writeheader()
+        writer.writerows(g_import_stats)
+    return base_path
+
+
+def smoothing_signature():
+    '''Describe all the settings the processed geometry depends on: the key of the cache together with the content of the file'''
+    return (f"reader={'native' if g_native_reader else 'legacy'};rot={g_rot_val_x},{g_rot_val_y},{g_rot_val_z};scale={g_scaling_x},{g_scaling_y},{g_scaling_z};"
+            f"remesh=SMOOTH,{g_remesh_depths},{g_remesh_size_threshold};decimate={g_decimate_ratio};"
+            f"budget={g_smoothing_mode},{g_target_faces},{g_target_edge}")
+
+
+def save_digest_index():
+    '''Store the digests of the files hashed during the import in the cache folder'''
+    if g_digest_index is not None:
+        g_digest_index.save()
+
+
+def import_matrix():
+    '''Return the rotation & scaling matrix applied to all imported meshes'''
+    return rotation_scaling_matrix((radians(g_rot_val_x), radians(g_rot_val_y), radians(g_rot_val_z)), (g_scaling_x, g_scaling_y, g_scaling_z))
+
+
+def load_import_manifest(scene):
+    '''Return the manifest of the files imported in the scene: {file path: {'size', 'mtime', 'object'}}'''
+    return json.loads(scene.get(g_manifest_key, '{}'))
+
+
+def save_import_manifest(scene, manifest):
+    '''Store the manifest of the imported files in the scene (hence in the .blend file)'''
+    scene[g_manifest_key] = json.dumps(manifest)
+
+
+def manifest_key(inFilePath):
+    '''Key of a file in the manifest: its absolute path'''
+    return Path(inFilePath).resolve().as_posix()
+
+
+def record_import(manifest, inFilePath, inSize, inMtime, obj):
+    '''Add a freshly imported file (size and modification time from the scan of the folder) and the name of the resulting object to the manifest'''
+    manifest[manifest_key(inFilePath)] = {'size': inSize, 'mtime': inMtime, 'object': obj.name}
+
+
+def files_to_import(inMeshFiles, manifest):
+    '''Return the paths of the files (subfolder, file path, size, modification time from the scan of the folder) that are new or changed
+    since their import. The objects of the changed files are removed so that they are replaced.
+    Files whose object was deleted from the scene are imported again.'''
+    # Cells packed in a single object per time point: {name: (packed object name, cell id)}
+    packed_cells = {name: (obj.name, cell_id) for obj in bpy.data.objects if is_packed(obj)
+                    for cell_id, name in enumerate(packed_cell_names(obj)) if name}
+    packed_to_remove = {}
+    to_import = []
+    for _, file_path, size, mtime in inMeshFiles:
+        entry = manifest.get(manifest_key(file_path))
+        if entry is not None:
+            obj = bpy.data.objects.get(entry['object'])
+            packed = packed_cells.get(entry['object'])
+            if (obj is not None or packed is not None) and entry['size'] == size and entry['mtime'] == mtime:
+                continue
+            if obj is not None:
+                mesh = obj.data
+                bpy.data.objects.remove(obj)
+                if mesh is not None and mesh.users == 0:
+                    bpy.data.meshes.remove(mesh)
+            elif packed is not None:
+                packed_to_remove.setdefault(packed[0], []).append(packed[1])
+            del manifest[manifest_key(file_path)]
+        to_import.append(file_path)
+    # Rebuild each packed object once
+    for name, cell_ids in packed_to_remove.items():
+        remove_packed_cells(bpy.data.objects[name], cell_ids)
+    return to_import
+
+
+def pack_collection(inColl):
+    '''Pack the cells of a collection in its packed object (created if needed): one mesh per time point'''
+    cells = [obj for obj in inColl.objects if obj.type == 'MESH' and not is_packed(obj)]
+    if cells:
+        return pack_objects(cells, packed_object(inColl), f"{inColl.name}_packed")
+    return packed_object(inColl)
+
+
+def prescan_mesh_files(inMeshFiles, inMinFaces=0, n_threads=8):
+    '''Read only the header of the files (subfolder, file path, size, modification time) to drop the ones with less than inMinFaces faces (debris)
+    and order the files of each subfolder largest first: the workers do not end up waiting on a large file read last.
+    Files without counts in their header (OBJ) are kept, after the PLY files and ordered by size. Return the files kept and the number skipped.
+    Without a minimum number of faces no header is read: the files are ordered by size.'''
+    if inMinFaces <= 0:
+        return sorted(inMeshFiles, key=lambda mesh_file: (mesh_file[0], -mesh_file[2])), 0
+    # Headers are tiny: the time is spent opening the files, which threads overlap (network shares)
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        counts = list(executor.map(read_mesh_counts, [mesh_file[1] for mesh_file in inMeshFiles]))
+    kept = [(mesh_file, count) for mesh_file, count in zip(inMeshFiles, counts) if count is None or count[1] >= inMinFaces]
+    kept.sort(key=lambda i: (i[0][0], i[1] is None, -(i[1][1] if i[1] is not None else 0), -i[0][2]))
+    return [mesh_file for mesh_file, _ in kept], len(inMeshFiles) - len(kept)
+
+
+def iter_mesh_files(inFilePaths, n_workers=1, window_per_worker=4):
+    '''Yield (file path, arrays) for each file, in order. When several workers are requested the files are read,
+    rotated and scaled in a pool of processes and the arrays (vertices, faces, center, time spent reading) are handed over
+    through shared memory, otherwise arrays is None
+    and the file is read on the main thread. Files found in the cache are not parsed (arrays is None): the ones whose digest is
+    known are not even dispatched, the others are hashed by the workers. Only a few files per worker are in flight at any time to bound memory.'''
+    if n_workers <= 1 or not g_native_reader or worker_context() is None:
+        for file_path in inFilePaths:
+            yield file_path, None
+        return
+    inFilePaths = list(inFilePaths)
+    # Files already in the cache are not read: import_process_assign() loads them from the cache
+    cached = set()
+    signature = smoothing_signature() if g_cache_dir else ''
+    if g_cache_dir:
+        for file_path in inFilePaths:
+            digest = g_digest_index.get(file_path)
+            if digest is not None and cached_mesh_path(g_cache_dir, digest, signature).exists():
+                cached.add(file_path)
+    matrix = import_matrix()
+    results = iter_worker_results(parse_to_shared_memory, ((file_path, matrix, g_cache_dir, signature) for file_path in inFilePaths if file_path not in cached),
+                                  n_workers, window_per_worker)
+    try:
+        for file_path in inFilePaths:
+            if file_path in cached:
+                yield file_path, None
+                continue
+            key, arrays = next(results)
+            if g_cache_dir:
+                # Hashed by the worker
+                file_path, digest = key
+                g_digest_index.put(file_path, digest)
+            yield file_path, arrays
+    finally:
+        results.close()
+
+
+def iter_label_meshes(inVolume, inBoxes, inVoxelSize, n_workers=1, window_per_worker=4):
+    '''Yield (label, arrays) for each label of a label volume (see label_bounding_boxes() for inBoxes): the arrays (vertices, faces,
+    center, time spent meshing) of its surface, rotated, scaled and centered. Labels are meshed in a pool of processes when several
+    workers are requested, in the order of inBoxes.'''
+    # The workers inherit the volume when forked
+    set_label_volume(inVolume)
+    try:
+        matrix = import_matrix()
+        tasks = [(label, box, inVoxelSize, matrix) for label, box in inBoxes.items()]
+        if n_workers <= 1 or worker_context() is None:
+            for task in tasks:
+                start = time.perf_counter()
+                yield task[0], (*mesh_label(*task), time.perf_counter() - start)
+        else:
+            yield from iter_worker_results(mesh_label_to_shared_memory, tasks, n_workers, window_per_worker)
+    finally:
+        set_label_volume(None)
+
+
+def iter_worker_results(inFunction, inTasks, n_workers, window_per_worker=4):
+    '''Run inFunction(*task) for each task in a pool of processes and yield (key, arrays) in the order of the tasks.
+    inFunction returns (key, vertices descriptor, faces descriptor, center, time spent) with the arrays in shared memory
+    (descriptors None: no arrays, None is yielded).
+    Only a few tasks per worker are in flight at any time to bound memory.'''
+    executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=worker_context())
+    pending = deque()
+    try:
+        tasks = iter(inTasks)
+        for task in tasks:
+            pending.append(executor.submit(inFunction, *task))
+            if len(pending) >= n_workers * window_per_worker:
+                break
+        while pending:
+            key, verts_desc, faces_desc, center, elapsed = pending.popleft().result()
+            # Keep the workers busy while the main thread creates the object
+            next_task = next(tasks, None)
+            if next_task is not None:
+                pending.append(executor.submit(inFunction, *next_task))
+            if verts_desc is None:
+                yield key, None
+            else:
+                yield key, (read_shared_array(verts_desc), read_shared_array(faces_desc), center, elapsed)
+    finally:
+        # Interrupted (error or cancel): free the shared memory of the results not consumed
+        executor.shutdown(wait=True, cancel_futures=True)
+        for future in pending:
+            if not future.cancelled() and future.exception() is None:
+                for desc in future.result()[1:3]:
+                    if desc is not None:
+                        free_shared_array(desc)
+
+
+def worker_context():
+    '''Multiprocessing context used for the worker processes, None if not available (the files are then read serially).
+    Workers must be forked: a spawned interpreter cannot import bpy, hence not the add-on. Forking is only safe on Linux:
+    on macOS a forked child of a multi-threaded process (Blender) can crash in the system frameworks.'''
+    if sys.platform.startswith('linux') and 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return None
+
+
+def smooth_color(inObj, inRecord=None):
+    '''Apply material and smoothing modifiers to an object. The time spent in each step is added to inRecord'''
+    record = {} if inRecord is None else inRecord
+    # Degree of smoothing depends on the size of the object (in internal Blender units - NO scaling applied)
+    # The mesh is not rotated/scaled by the object: its extent is the dimensions (inObj.dimensions is only valid once the object has been evaluated)
+    dims = mesh_dimensions(inObj.data)
+    area = surface_area(*mesh_to_arrays(inObj.data)) if g_smoothing_mode != 'FIXED' else 0.0
+    octree_factor, decimate_ratio = smoothing_parameters(dims, area)
+    # Each modifier is applied on its own to time it
+    with timed(record, 'remesh'):
+        remesh = inObj.modifiers.new(name='Remesh', type='REMESH')
+        remesh.octree_depth = octree_factor
+        remesh.scale = g_remesh_scale
+        remesh.use_smooth_shade = True
+        remesh.mode = 'SMOOTH'
+        inObj = apply_modifiers(inObj)
+    if decimate_ratio < 1:
+        with timed(record, 'decimate'):
+            decim = inObj.modifiers.new(name='Decimate', type='DECIMATE')
+            decim.ratio = decimate_ratio
+            inObj = apply_modifiers(inObj)
     # Add a color at random from the palette
-    assign_material(inObj, g_mat_palette, rand_color=True)
+    with timed(record, 'material'):
+        assign_material(inObj, g_mat_palette, rand_color=True)
     return inObj
 
+def smoothing_parameters(inDims, inArea):
+    '''Return the octree depth of the Remesh and the ratio of the Decimate for a cell of dimensions inDims and area inArea (Blender units).
+    FIXED: depth from the size of the cell, fixed ratio (large objects --> higher octree depth --> more details).
+    FACES / EDGE: the cell should end up with a target number of triangles, given or derived from a target edge length. The Remesh
+    makes quads of about (largest dimension / (scale * 2^depth)) wide: the depth is the lowest giving more triangles than the target
+    and the Decimate brings them down to the target.'''
+    if g_smoothing_mode == 'FIXED':
+        if max(inDims) > g_remesh_size_threshold:
+            return g_remesh_depths[1], g_decimate_ratio
+        return g_remesh_depths[0], g_decimate_ratio
+    if g_smoothing_mode == 'EDGE':
+        # Number of equilateral triangles of that edge length (µm --> Blender units) covering the surface
+        edge = g_target_edge / bpy.context.scene.unit_settings.scale_length
+        target = 4 * inArea / (sqrt(3) * edge ** 2)
+    else:
+        target = g_target_faces
+    target = max(target, g_min_triangles)
+    size = max(max(inDims), 1e-9)
+    for depth in range(g_remesh_depth_range[0], g_remesh_depth_range[1] + 1):
+        n_triangles = 2 * inArea / (size / (g_remesh_scale * 2 ** depth)) ** 2
+        if n_triangles >= target:
+            break
+    return depth, min(1.0, target / max(n_triangles, 1))
+
+
 def scale_rotate(inObj, inAngles, inScaling):
-    '''Low level rotation & scaling of an object'''
-    rot_x = Matrix.Rotation(inAngles[0], 4, 'X')
-    rot_y = Matrix.Rotation(inAngles[1], 4, 'Y')
-    rot_z = Matrix.Rotation(inAngles[2], 4, 'Z')
-    rot_mat = rot_x @ rot_y @ rot_z
-    scale_mat = (Matrix.Scale(inScaling[0], 4, (1, 0, 0)) @ Matrix.Scale(inScaling[1], 4, (0, 1, 0)) @ Matrix.Scale(inScaling[2], 4, (0, 0, 1)))
-    # assemble the new matrix
-    inObj.matrix_world @= rot_mat @  scale_mat
-    # 'burn' the transformations by transforming the mesh using the matrix world & then reset it
-    inObj.data.transform(inObj.matrix_world)
-    inObj.matrix_world @= inObj.matrix_world.inverted()
-    # Redefine the origin of each mesh to its center.
-    bpy.ops.object.origin_set(type='ORIGIN_CENTER_OF_VOLUME', center='MEDIAN')
-    # bpy.ops.object.origin_set(type='ORIGIN_GEOMETRY', center='MEDIAN')
+    '''Low level rotation & scaling of an object, its origin is then set to its center of volume.
+    Works on the vertex array: no operator, hence independent of the selection and safe in batch or background runs.'''
+    # Same as burning matrix_world @ rot @ scale into the mesh
+    matrix = np.array(inObj.matrix_world) @ rotation_scaling_matrix(inAngles, inScaling)
+    verts, tris = mesh_to_arrays(inObj.data)
+    verts, center = transform_and_center(verts, tris, matrix)
+    inObj.data.vertices.foreach_set('co', verts.astype(np.float32).ravel())
+    inObj.data.update()
+    # Move the object back in place
+    inObj.matrix_world = Matrix.Translation(Vector(center))
     return inObj
 
-def initialise(in_mat_palette, in_voxel_xyz, in_rot_val_xyz):
+
+def initialise(in_mat_palette, in_voxel_xyz, in_rot_val_xyz, in_native_reader=True, in_cache_dir='',
+               in_smoothing_mode='FIXED', in_target_faces=2000, in_target_edge=1.0):
     '''Initialise everything before import: create material palette, set units and scaling'''
     global g_mat_palette
+    global g_smoothing_mode, g_target_faces, g_target_edge
+    global g_native_reader
+    global g_cache_dir, g_digest_index
     global g_scaling_x, g_scaling_y, g_scaling_z
     global g_rot_val_x, g_rot_val_y, g_rot_val_z
     global g_import_coll_name
+    # Start a new report
+    g_import_stats.clear()
     # Create materials palette
     g_mat_palette = create_materials_palette(in_mat_palette)
     # Make sure that the collection 'Imported' exists and is selected that Collection as active one
@@ -90,6 +473,15 @@ def initialise(in_mat_palette, in_voxel_xyz, in_rot_val_xyz):
     bpy.context.view_layer.active_layer_collection = bpy.context.view_layer.layer_collection.children[g_import_coll_name]
     # Make sure nothing is selected
     bpy.ops.object.select_all(action='DESELECT')
+    # Read the files with the built-in reader or with the Blender importers
+    g_native_reader = in_native_reader
+    # Resolution of the smoothed meshes: fixed, number of triangles per cell or edge length (µm)
+    g_smoothing_mode = in_smoothing_mode
+    g_target_faces = in_target_faces
+    g_target_edge = in_target_edge
+    # Folder of the cache of processed meshes (disabled if empty)
+    g_cache_dir = bpy.path.abspath(in_cache_dir) if in_cache_dir else ''
+    g_digest_index = DigestIndex(g_cache_dir) if g_cache_dir else None
     # Rotations (deg)
     g_rot_val_x = in_rot_val_xyz[0]
     g_rot_val_y = in_rot_val_xyz[1]
@@ -121,9 +513,11 @@ class ImportProperties(bpy.types.PropertyGroup):
 
     def update_progress_bar(self, context):
         ''' update function to force redraw of the progress bar'''
+        if context.window is None:  # Background mode
+            return
         areas = context.window.screen.areas
         for area in areas:
-            if area.type == 'INFO':
+            if area.type in {'INFO', 'VIEW_3D'}:
                 area.tag_redraw()
 
     import_path: StringProperty(
@@ -165,6 +559,77 @@ class ImportProperties(bpy.types.PropertyGroup):
         max=180,
         subtype='EULER'
         )
+    bool_incremental: BoolProperty(
+        name='Skip imported',
+        description='Skip the files already imported and unchanged since, re-import the ones that changed',
+        default=True
+        )
+    smoothing_mode: EnumProperty(
+        name='Resolution',
+        description='Resolution of the smoothed cells',
+        items=[('FIXED', 'Size classes', 'Two levels of details depending on the size of the cell, half of the faces kept'),
+               ('FACES', 'Face budget', 'Same number of triangles for every cell'),
+               ('EDGE', 'Edge length', 'Same density of triangles for every cell: number of triangles proportional to the area'),
+               ],
+        default='FIXED'
+        )
+    target_faces: IntProperty(
+        name='Triangles',
+        description='Number of triangles of each cell after smoothing',
+        default=2000,
+        min=200,
+        max=1000000
+        )
+    target_edge: FloatProperty(
+        name='Edge (µm)',
+        description='Length of the edges of the triangles after smoothing (µm)',
+        default=1.0,
+        min=0.01,
+        max=100,
+        precision=2
+        )
+    bool_pack: BoolProperty(
+        name='Pack time points',
+        description='Store all the cells of a time point in a single mesh (face attribute cell_id): much lighter for large datasets. '
+                    'Cells can be unpacked for editing',
+        default=False
+        )
+    min_faces: IntProperty(
+        name='Min faces',
+        description='Skip the files with fewer faces (debris), read from the PLY header before loading anything (0 to import all)',
+        default=0,
+        min=0
+        )
+    label_path: StringProperty(
+        name='Labels',
+        description='Segmentation to mesh and import: label volume (.npy, or TIFF stack if tifffile is installed) indexed z, y, x',
+        default='',
+        subtype='FILE_PATH'
+        )
+    label_background: IntProperty(
+        name='Background',
+        description='Label of the background in the label volume, not imported',
+        default=0,
+        min=0
+        )
+    cache_path: StringProperty(
+        name='Cache',
+        description='Folder where the processed meshes are cached to speed up re-imports (leave empty to disable)',
+        default='',
+        subtype='DIR_PATH'
+        )
+    n_workers: IntProperty(
+        name='Workers',
+        description='Number of processes reading the files in parallel (requires the fast reader)',
+        default=max(1, (os.cpu_count() or 1) - 1),
+        min=1,
+        max=256
+        )
+    bool_native_reader: BoolProperty(
+        name='Fast reader',
+        description='Read the files with the built-in reader instead of the Blender importers',
+        default=True
+        )
     progress_bar: FloatProperty(
         name='Import',
         description='',
@@ -200,31 +665,197 @@ class MORPHOBLEND_OT_Import(bpy.types.Operator):
         import_prop = context.scene.import_prop
         return import_prop.import_path != ''
 
+    # Time spent importing files before handing control back to the interface (s)
+    time_budget = 0.25
+    item_name = 'files'
+
+    def invoke(self, context, event):
+        self.prepare(context)
+        # Import by batches from a timer: the interface stays responsive and the import can be cancelled
+        wm = context.window_manager
+        self._timer = wm.event_timer_add(0.01, window=context.window)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            self.finish(context)
+            self.report({'WARNING'}, f"Import cancelled: {self.n_files_imported}/{self.n_files_to_import} {self.item_name} imported")
+            return {'CANCELLED'}
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+        done = False
+        try:
+            start = time.perf_counter()
+            while time.perf_counter() - start < self.time_budget:
+                item = next(self.files, None)
+                if item is None:
+                    done = True
+                    break
+                self.import_file(context, *item)
+            if not done:
+                self.show_progress(context)
+                return {'RUNNING_MODAL'}
+        except Exception as error:
+            # Do not leave the timer, the status text and the workers behind: stop and keep what was imported so far
+            self.finish(context)
+            self.report({'ERROR'}, f"Import failed after {self.n_files_imported}/{self.n_files_to_import} {self.item_name}: {error}")
+            return {'CANCELLED'}
+        self.finish(context)
+        message = f"{self.n_files_imported} {self.item_name} imported in {time.perf_counter() - self.start_time:.0f}s"
+        if self.n_files_skipped > 0:
+            message = f"{message}, {self.n_files_skipped} skipped (less than {context.scene.import_prop.min_faces} faces)"
+        self.report({'INFO'}, message)
+        return {'FINISHED'}
+
     def execute(self, context):
-        # Initialise scene and progress bar
+        # Blocking import, e.g. when called from a script
+        self.prepare(context)
+        try:
+            for item in self.files:
+                self.import_file(context, *item)
+        finally:
+            self.finish(context)
+        return {'FINISHED'}
+
+    def prepare(self, context):
+        '''Initialise scene and progress bar, list the files to import'''
         import_prop = context.scene.import_prop
         import_prop.progress_bar = 0
-        initialise('Qual_bright', import_prop.vox_dim, import_prop.rot_xyz)
-        folder_path = Path(bpy.path.abspath(import_prop.import_path))
-        num_files_to_import = number_of_file_to_import(folder_path, g_allowed_extension)
-        n_files_imported = 0 
-        
-        # Traverse through the folder and its subfolders
-        for file_path in sorted(folder_path.glob('**/*')):
-            # Check if the file extension is in the specified list of extensions
-            folder_name = file_path.parent.name
-            if file_path.suffix.upper() in g_allowed_extension:
-                # Check if the parent folder name is already present in collection
-                if folder_name not in bpy.data.collections:
-                    coll = bpy.data.collections.new(name=folder_name)
-                    bpy.context.scene.collection.children.link(coll)
-                else:
-                    coll = bpy.data.collections[folder_name]
-                import_process_assign(inFilePath=file_path.as_posix(), inColl=coll)
-                n_files_imported = n_files_imported + 1
-                import_prop.progress_bar = n_files_imported / num_files_to_import * 100
-                bpy.ops.wm.redraw_timer(type='DRAW_WIN_SWAP', iterations=1)
-        return {'FINISHED'}
+        initialise('Qual_bright', import_prop.vox_dim, import_prop.rot_xyz, import_prop.bool_native_reader, import_prop.cache_path,
+                   import_prop.smoothing_mode, import_prop.target_faces, import_prop.target_edge)
+        # Traverse through the folder and its subfolders, keep the files with the right extension
+        mesh_files = scan_mesh_files(bpy.path.abspath(import_prop.import_path), g_allowed_extension)
+        # The manifest of the earlier imports is kept: only the entries of the files imported now are updated
+        self.manifest = load_import_manifest(context.scene)
+        if import_prop.bool_incremental:
+            # Only import the files not imported yet or changed since
+            file_paths = set(files_to_import(mesh_files, self.manifest))
+        else:
+            file_paths = {mesh_file[1] for mesh_file in mesh_files}
+        mesh_files = [mesh_file for mesh_file in mesh_files if mesh_file[1] in file_paths]
+        # Skip the debris (only the headers of the files left are read), largest files first
+        mesh_files, self.n_files_skipped = prescan_mesh_files(mesh_files, import_prop.min_faces)
+        file_paths = [mesh_file[1] for mesh_file in mesh_files]
+        # Progress is measured in bytes: the time to import a file grows with its size
+        self.file_stats = {file_path: (size, mtime) for _, file_path, size, mtime in mesh_files}
+        self.n_files_to_import = len(file_paths)
+        self.n_files_imported = 0
+        self.collections = set()
+        self.n_bytes_to_import = sum(self.file_stats[file_path][0] for file_path in file_paths)
+        self.n_bytes_imported = 0
+        self.start_time = time.perf_counter()
+        # Files are read in parallel, objects are created on the main thread
+        self.files = iter_mesh_files(file_paths, import_prop.n_workers)
+
+    def import_file(self, context, file_path, arrays):
+        '''Import one file into the collection named after its folder'''
+        folder_name = Path(file_path).parent.name
+        # Check if the parent folder name is already present in collection
+        if folder_name not in bpy.data.collections:
+            coll = bpy.data.collections.new(name=folder_name)
+            bpy.context.scene.collection.children.link(coll)
+        else:
+            coll = bpy.data.collections[folder_name]
+        obj = import_process_assign(inFilePath=file_path, inColl=coll, inArrays=arrays)
+        size, mtime = self.file_stats[file_path]
+        record_import(self.manifest, file_path, size, mtime, obj)
+        self.collections.add(coll.name)
+        self.n_files_imported = self.n_files_imported + 1
+        self.n_bytes_imported = self.n_bytes_imported + size
+
+    def show_progress(self, context):
+        '''Update the progress bar and display the import rate and remaining time in the status bar'''
+        import_prop = context.scene.import_prop
+        import_prop.progress_bar = self.n_bytes_imported / max(self.n_bytes_to_import, 1) * 100
+        elapsed = time.perf_counter() - self.start_time
+        rate = self.n_files_imported / elapsed if elapsed > 0 else 0
+        byte_rate = self.n_bytes_imported / elapsed if elapsed > 0 else 0
+        eta = (self.n_bytes_to_import - self.n_bytes_imported) / byte_rate if byte_rate > 0 else 0
+        context.workspace.status_text_set(f"Import: {self.n_files_imported}/{self.n_files_to_import} {self.item_name} - "
+                                          f"{rate:.1f} {self.item_name}/s - ETA {int(eta // 60)}min {int(eta % 60):02}s - [Esc] to cancel")
+
+    def finish(self, context):
+        '''Stop the workers, remove the timer and store the files imported so far, even if one of these steps fails'''
+        try:
+            self.files.close()
+            # One mesh per time point
+            if context.scene.import_prop.bool_pack:
+                for coll_name in self.collections:
+                    pack_collection(bpy.data.collections[coll_name])
+        finally:
+            if getattr(self, '_timer', None) is not None:
+                context.window_manager.event_timer_remove(self._timer)
+                self._timer = None
+                context.workspace.status_text_set(None)
+            save_import_manifest(context.scene, self.manifest)
+            save_digest_index()
+        # Time spent in each stage of the import
+        print('\n'.join(import_report_summary()))
+        context.scene.import_prop.progress_bar = self.n_bytes_imported / max(self.n_bytes_to_import, 1) * 100
+
+
+class MORPHOBLEND_OT_ImportLabels(MORPHOBLEND_OT_Import):
+    '''Mesh all the cells of a segmentation (label volume: .npy or TIFF stack) and import them'''
+    bl_idname = 'morphoblend.import_labels'
+    bl_label = 'Import labels'
+    item_name = 'cells'
+
+    @classmethod
+    def poll(cls, context):
+        import_prop = context.scene.import_prop
+        return Path(import_prop.label_path).suffix.lower() in g_label_extensions
+
+    def invoke(self, context, event):
+        try:
+            return super().invoke(context, event)
+        except (ImportError, ValueError) as error:
+            self.report({'ERROR'}, str(error))
+            return {'CANCELLED'}
+
+    def execute(self, context):
+        try:
+            return super().execute(context)
+        except (ImportError, ValueError) as error:
+            self.report({'ERROR'}, str(error))
+            return {'CANCELLED'}
+
+    def prepare(self, context):
+        '''Initialise scene and progress bar, read the label volume and locate the cells'''
+        import_prop = context.scene.import_prop
+        import_prop.progress_bar = 0
+        initialise('Qual_bright', import_prop.vox_dim, import_prop.rot_xyz, True, '',
+                   import_prop.smoothing_mode, import_prop.target_faces, import_prop.target_edge)
+        self.volume_path = Path(bpy.path.abspath(import_prop.label_path)).as_posix()
+        volume = read_label_volume(self.volume_path)
+        boxes = label_bounding_boxes(volume, import_prop.label_background)
+        # Largest cells first; progress is measured in voxels of the bounding boxes
+        self.label_sizes = {label: int(np.prod(np.subtract(high, low))) for label, (low, high) in boxes.items()}
+        boxes = dict(sorted(boxes.items(), key=lambda i: -self.label_sizes[i[0]]))
+        # One collection per volume, named after the file
+        coll_name = Path(self.volume_path).stem
+        if coll_name not in bpy.data.collections:
+            self.coll = bpy.data.collections.new(name=coll_name)
+            bpy.context.scene.collection.children.link(self.coll)
+        else:
+            self.coll = bpy.data.collections[coll_name]
+        # The cells of a label volume are not recorded in the manifest of the imported files
+        self.manifest = load_import_manifest(context.scene)
+        self.n_files_skipped = 0
+        self.n_files_to_import = len(boxes)
+        self.n_files_imported = 0
+        self.collections = set()
+        self.n_bytes_to_import = sum(self.label_sizes.values())
+        self.n_bytes_imported = 0
+        self.start_time = time.perf_counter()
+        self.files = iter_label_meshes(volume, boxes, tuple(import_prop.vox_dim), import_prop.n_workers)
+
+    def import_file(self, context, label, arrays):
+        '''Import one cell of the volume'''
+        import_process_assign(inColl=self.coll, inFilePath=self.volume_path, inArrays=arrays, inName=str(label))
+        self.collections.add(self.coll.name)
+        self.n_files_imported = self.n_files_imported + 1
+        self.n_bytes_imported = self.n_bytes_imported + self.label_sizes[label]
 
 
 class MORPHOBLEND_OT_TranslateToCenter(bpy.types.Operator):
@@ -290,12 +921,34 @@ class MORPHOBLEND_PT_Import(bpy.types.Panel):
         row.label(text='Apply rotation (deg):')
         row = box.row()
         row.prop(import_prop, 'rot_xyz')
+        row = box.row()
+        row.prop(import_prop, 'bool_native_reader')
+        row.prop(import_prop, 'n_workers')
+        row = box.row()
+        row.prop(import_prop, 'bool_incremental')
+        row.prop(import_prop, 'min_faces')
+        row = box.row()
+        row.prop(import_prop, 'smoothing_mode')
+        if import_prop.smoothing_mode == 'FACES':
+            row.prop(import_prop, 'target_faces')
+        elif import_prop.smoothing_mode == 'EDGE':
+            row.prop(import_prop, 'target_edge')
+        row = box.row()
+        row.prop(import_prop, 'bool_pack')
+        row = box.row()
+        row.prop(import_prop, 'cache_path')
 
         layout.row().separator()
         row = layout.row()
 
         op = row.operator(MORPHOBLEND_OT_Import.bl_idname, text='Import', icon='IMPORT')
 
+        row = layout.row()
+        row.prop(import_prop, 'label_path')
+        row = layout.row()
+        row.prop(import_prop, 'label_background')
+        row.operator(MORPHOBLEND_OT_ImportLabels.bl_idname, text='Import labels', icon='MESH_ICOSPHERE')
+
         row = layout.row()
         row.prop(import_prop, 'progress_bar', slider=True)
 
@@ -306,7 +959,7 @@ class MORPHOBLEND_PT_Import(bpy.types.Panel):
 # ------------------------------------------------------------------------
 #    Registrer/unregister calls
 # ------------------------------------------------------------------------
-classes = (ImportProperties, MORPHOBLEND_OT_Import, MORPHOBLEND_OT_TranslateToCenter)
+classes = (ImportProperties, MORPHOBLEND_OT_Import, MORPHOBLEND_OT_ImportLabels, MORPHOBLEND_OT_TranslateToCenter)
 
 register_classes, unregister_classes = bpy.utils.register_classes_factory(classes)
 
@@ -0,0 +1,654 @@
+import hashlib
+import json
+import os
+import time
+from multiprocessing import resource_tracker, shared_memory
+from pathlib import Path
+
+import numpy as np
+
+# Low level readers for the mesh files produced by the segmentation pipelines.
+# This module does NOT import bpy: everything here works on plain NumPy arrays so that it can be used
+# from the add-on, from the headless scripts and from worker processes alike.
+
+# ------------------------------------------------------------------------
+#    Global variables
+# ------------------------------------------------------------------------
+# Correspondence between the PLY scalar types and the NumPy ones
+g_ply_types = {'char': 'i1', 'int8': 'i1',
+               'uchar': 'u1', 'uint8': 'u1',
+               'short': 'i2', 'int16': 'i2',
+               'ushort': 'u2', 'uint16': 'u2',
+               'int': 'i4', 'int32': 'i4',
+               'uint': 'u4', 'uint32': 'u4',
+               'float': 'f4', 'float32': 'f4',
+               'double': 'f8', 'float64': 'f8'}
+
+g_ply_byte_order = {'ascii': '=', 'binary_little_endian': '<', 'binary_big_endian': '>'}
+
+# Formats of the label volumes
+g_label_extensions = ('.npy', '.tif', '.tiff')
+# Label volume being meshed: set before the worker processes are forked, which inherit it without copy
+g_label_volume = None
+
+
+# ------------------------------------------------------------------------
+#    PLY
+# ------------------------------------------------------------------------
+def read_ply_header(inFilePath):
+    '''Parse the header of a PLY file. Return the format, the list of elements and the length of the header in bytes.
+    Each element is a dict: {'name', 'count', 'properties'} with properties a list of (name, type, list_count_type or None)'''
+    elements = []
+    with open(inFilePath, 'rb') as f:
+        if f.readline().strip() != b'ply':
+            raise ValueError(f"{inFilePath} is not a PLY file.")
+        ply_format = None
+        while True:
+            line = f.readline()
+            if not line:
+                raise ValueError(f"{inFilePath}: unexpected end of file in header.")
+            tokens = line.decode('ascii', errors='replace').split()
+            if not tokens or tokens[0] in ('comment', 'obj_info'):
+                continue
+            if tokens[0] == 'format':
+                ply_format = tokens[1]
+            elif tokens[0] == 'element':
+                elements.append({'name': tokens[1], 'count': int(tokens[2]), 'properties': []})
+            elif tokens[0] == 'property':
+                if tokens[1] == 'list':
+                    elements[-1]['properties'].append((tokens[4], g_ply_types[tokens[3]], g_ply_types[tokens[2]]))
+                else:
+                    elements[-1]['properties'].append((tokens[2], g_ply_types[tokens[1]], None))
+            elif tokens[0] == 'end_header':
+                header_length = f.tell()
+                break
+    if ply_format not in g_ply_byte_order:
+        raise ValueError(f"{inFilePath}: unsupported PLY format '{ply_format}'.")
+    return ply_format, elements, header_length
+
+
+def read_ply(inFilePath):
+    '''Read a PLY file (ASCII or binary). Return the vertices as a (N, 3) float array and the faces as a (M, 3) int array of triangles'''
+    ply_format, elements, header_length = read_ply_header(inFilePath)
+    with open(inFilePath, 'rb') as f:
+        f.seek(header_length)
+        body = f.read()
+    if ply_format == 'ascii':
+        return _read_ply_ascii(body, elements)
+    return _read_ply_binary(body, elements, g_ply_byte_order[ply_format])
+
+
+def read_mesh_counts(inFilePath):
+    '''Return the number of vertices and faces of a mesh file from its header, without reading the geometry.
+    None when the counts are not in a header (OBJ) or the header can not be read'''
+    if Path(inFilePath).suffix.lower() != '.ply':
+        return None
+    try:
+        _, elements, _ = read_ply_header(inFilePath)
+    except (OSError, ValueError, KeyError, IndexError):
+        return None
+    counts = {element['name']: element['count'] for element in elements}
+    return counts.get('vertex', 0), counts.get('face', 0)
+
+
+def _read_ply_binary(body, elements, byte_order):
+    '''Read the vertex and face elements from the body of a binary PLY file'''
+    verts = np.zeros((0, 3), dtype=np.float32)
+    faces = np.zeros((0, 3), dtype=np.int32)
+    offset = 0
+    for element in elements:
+        props = element['properties']
+        count = element['count']
+        if all(p[2] is None for p in props):
+            # Only scalar properties: the element is a plain structured array
+            dtype = np.dtype([(p[0], byte_order + p[1]) for p in props])
+            data = np.frombuffer(body, dtype=dtype, count=count, offset=offset)
+            offset += dtype.itemsize * count
+            if element['name'] == 'vertex':
+                verts = np.column_stack((data['x'], data['y'], data['z'])).astype(np.float32)
+        elif element['name'] == 'face':
+            faces, offset = _read_ply_binary_faces(body, element, byte_order, offset)
+        else:
+            # An element with lists we do not use: walk over it to get to the next one
+            offset = _skip_ply_binary_element(body, element, byte_order, offset)
+    return verts, faces
+
+
+def _read_ply_binary_faces(body, element, byte_order, offset):
+    '''Read the faces of a binary PLY file. Return the triangles and the offset of the next element'''
+    props = element['properties']
+    count = element['count']
+    if count == 0:
+        return np.zeros((0, 3), dtype=np.int32), offset
+    list_props = [p for p in props if p[2] is not None]
+    if len(list_props) == 1:
+        # Fast path: all the faces have the same number of vertices (triangles for all our meshes)
+        idx_name = list_props[0][0]
+        first_count_dtype = np.dtype(byte_order + list_props[0][2])
+        pre_size = sum(np.dtype(p[1]).itemsize for p in props[:props.index(list_props[0])])
+        n_per_face = int(np.frombuffer(body, dtype=first_count_dtype, count=1, offset=offset + pre_size)[0])
+        fields = []
+        for p in props:
+            if p[2] is None:
+                fields.append((p[0], byte_order + p[1]))
+            else:
+                fields.append(('n_' + p[0], byte_order + p[2]))
+                fields.append((p[0], byte_order + p[1], (n_per_face,)))
+        dtype = np.dtype(fields)
+        if offset + dtype.itemsize * count <= len(body):
+            data = np.frombuffer(body, dtype=dtype, count=count, offset=offset)
+            if np.all(data['n_' + idx_name] == n_per_face):
+                polys = data[idx_name].reshape(count, n_per_face)
+                return triangulate_fan(polys), offset + dtype.itemsize * count
+    # Slow path: faces with a varying number of vertices
+    polys = []
+    for _ in range(count):
+        for p in props:
+            if p[2] is None:
+                offset += np.dtype(p[1]).itemsize
+            else:
+                n = int(np.frombuffer(body, dtype=byte_order + p[2], count=1, offset=offset)[0])
+                offset += np.dtype(p[2]).itemsize
+                polys.append(np.frombuffer(body, dtype=byte_order + p[1], count=n, offset=offset))
+                offset += np.dtype(p[1]).itemsize * n
+    return triangulate_polygons(polys), offset
+
+
+def _skip_ply_binary_element(body, element, byte_order, offset):
+    '''Return the offset just after an element containing lists'''
+    for _ in range(element['count']):
+        for p in element['properties']:
+            if p[2] is None:
+                offset += np.dtype(p[1]).itemsize
+            else:
+                n = int(np.frombuffer(body, dtype=byte_order + p[2], count=1, offset=offset)[0])
+                offset += np.dtype(p[2]).itemsize + np.dtype(p[1]).itemsize * n
+    return offset
+
+
+def _read_ply_ascii(body, elements):
+    '''Read the vertex and face elements from the body of an ASCII PLY file'''
+    verts = np.zeros((0, 3), dtype=np.float32)
+    faces = np.zeros((0, 3), dtype=np.int32)
+    lines = body.decode('ascii', errors='replace').splitlines()
+    lines = [line for line in lines if line.strip()]
+    start = 0
+    for element in elements:
+        count = element['count']
+        props = element['properties']
+        element_lines = lines[start:start + count]
+        start += count
+        if element['name'] == 'vertex':
+            names = [p[0] for p in props]
+            data = np.array(' '.join(element_lines).split(), dtype=np.float64).reshape(count, len(props))
+            verts = data[:, [names.index('x'), names.index('y'), names.index('z')]].astype(np.float32)
+        elif element['name'] == 'face' and count > 0:
+            # Position of the list in the line, assuming the scalar properties come first
+            list_pos = [i for i, p in enumerate(props) if p[2] is not None][0]
+            rows = [line.split() for line in element_lines]
+            n_tokens = len(rows[0])
+            if all(len(r) == n_tokens for r in rows):
+                data = np.array(rows, dtype=np.int64)
+                n_per_face = int(data[0, list_pos])
+                polys = data[:, list_pos + 1:list_pos + 1 + n_per_face]
+                faces = triangulate_fan(polys)
+            else:
+                polys = [np.array(r[list_pos + 1:list_pos + 1 + int(r[list_pos])], dtype=np.int64) for r in rows]
+                faces = triangulate_polygons(polys)
+    return verts, faces
+
+
+# ------------------------------------------------------------------------
+#    OBJ
+# ------------------------------------------------------------------------
+def read_obj(inFilePath):
+    '''Read a Wavefront OBJ file. Return the vertices as a (N, 3) float array and the faces as a (M, 3) int array of triangles.
+    OBJ files are Y up: the vertices are converted to Z up, (x, y, z) -> (x, -z, y), as the OBJ importer of Blender does by default'''
+    v_lines = []
+    polys = []
+    n_verts = 0
+    with open(inFilePath, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if line.startswith('v '):
+                v_lines.append(line[2:])
+                n_verts += 1
+            elif line.startswith('f '):
+                # Only keep the vertex index of each 'v/vt/vn' group. OBJ indices start at 1, negative ones are relative
+                idx = [int(t.split('/')[0]) for t in line[2:].split()]
+                polys.append(np.array([i - 1 if i > 0 else n_verts + i for i in idx], dtype=np.int64))
+    if v_lines:
+        verts = np.array(' '.join(v_lines).split(), dtype=np.float64).reshape(len(v_lines), -1)[:, :3].astype(np.float32)
+        # Y up to Z up (axis_forward='-Z', axis_up='Y')
+        verts = np.stack((verts[:, 0], -verts[:, 2], verts[:, 1]), axis=1)
+    else:
+        verts = np.zeros((0, 3), dtype=np.float32)
+    return verts, triangulate_polygons(polys)
+
+
+# ------------------------------------------------------------------------
+#    Common
+# ------------------------------------------------------------------------
+def read_mesh(inFilePath):
+    '''Read a PLY or OBJ file, the format is deduced from the extension (case insensitive)'''
+    suffix = Path(inFilePath).suffix.lower()
+    if suffix == '.ply':
+        return read_ply(inFilePath)
+    elif suffix == '.obj':
+        return read_obj(inFilePath)
+    raise ValueError(f"Unsupported file format: {inFilePath}")
+
+
+def triangulate_fan(polys):
+    '''Triangulate a (M, k) array of convex polygons sharing the same number of vertices'''
+    polys = np.asarray(polys, dtype=np.int32)
+    k = polys.shape[1]
+    if k == 3:
+        return np.ascontiguousarray(polys)
+    tris = [polys[:, [0, i, i + 1]] for i in range(1, k - 1)]
+    return np.stack(tris, axis=1).reshape(-1, 3)
+
+
+def triangulate_polygons(polys):
+    '''Triangulate a list of polygons of varying number of vertices'''
+    if not polys:
+        return np.zeros((0, 3), dtype=np.int32)
+    tris = [[p[0], p[i], p[i + 1]] for p in polys for i in range(1, len(p) - 1)]
+    return np.array(tris, dtype=np.int32).reshape(-1, 3)
+
+
+def triangulate_loops(loops, face_sizes):
+    '''Fan triangulation of faces given as the flat array of their vertex indices and the number of vertices of each face'''
+    face_sizes = np.asarray(face_sizes)
+    if len(face_sizes) == 0:
+        return np.zeros((0, 3), dtype=np.int32)
+    loop_starts = np.concatenate(([0], np.cumsum(face_sizes)[:-1]))
+    tris = []
+    for i in range(1, face_sizes.max() - 1):
+        # i-th triangle of the faces having at least i + 2 vertices
+        starts = loop_starts[face_sizes > i + 1]
+        tris.append(np.stack([loops[starts], loops[starts + i], loops[starts + i + 1]], axis=1))
+    return np.concatenate(tris).astype(np.int32)
+
+
+# ------------------------------------------------------------------------
+#    Transformations
+# ------------------------------------------------------------------------
+def rotation_scaling_matrix(inAngles, inScaling):
+    '''Return the 4x4 matrix rotating around X, Y, Z (angles in radians) after an anisotropic scaling.
+    Same as (Rot_x @ Rot_y @ Rot_z @ Scale) built with mathutils.Matrix'''
+    cx, cy, cz = np.cos(inAngles)
+    sx, sy, sz = np.sin(inAngles)
+    rot_x = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+    rot_y = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    rot_z = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+    matrix = np.identity(4)
+    matrix[:3, :3] = rot_x @ rot_y @ rot_z @ np.diag(inScaling)
+    return matrix
+
+
+def transform_vertices(verts, matrix):
+    '''Apply a 4x4 transformation matrix to a (N, 3) array of vertices'''
+    matrix = np.asarray(matrix, dtype=np.float64)
+    return np.asarray(verts, dtype=np.float64) @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+def volume_centroid(verts, faces):
+    '''Return the center of volume of a closed triangle mesh, computed from the signed volumes of the tetrahedra
+    formed by each triangle and a reference point (same as ORIGIN_CENTER_OF_VOLUME). Falls back to the mean of the vertices for flat meshes.'''
+    verts = np.asarray(verts, dtype=np.float64)
+    if len(verts) == 0:
+        return np.zeros(3)
+    # Use the mean of the vertices as reference point to limit the rounding errors
+    ref = verts.mean(axis=0)
+    if len(faces) == 0:
+        return ref
+    v0 = verts[faces[:, 0]] - ref
+    v1 = verts[faces[:, 1]] - ref
+    v2 = verts[faces[:, 2]] - ref
+    tetra_volumes = np.einsum('ij,ij->i', v0, np.cross(v1, v2)) / 6
+    volume = tetra_volumes.sum()
+    if abs(volume) <= np.finfo(np.float32).eps * np.abs(tetra_volumes).sum():
+        return ref
+    # The centroid of each tetrahedron is (v0 + v1 + v2 + ref) / 4
+    return ref + (tetra_volumes[:, None] * (v0 + v1 + v2)).sum(axis=0) / (4 * volume)
+
+
+def volumes_and_areas(verts, faces, inMeshIndex, inNumberOfMeshes):
+    '''Return the signed volume and the area of several triangle meshes at once: the vertices and faces of all the meshes are
+    concatenated and inMeshIndex gives the mesh of each face'''
+    verts = np.asarray(verts, dtype=np.float64)
+    v0, v1, v2 = verts[faces[:, 0]], verts[faces[:, 1]], verts[faces[:, 2]]
+    # Signed volume of the tetrahedra formed by each triangle and the origin
+    volumes = np.bincount(inMeshIndex, weights=np.einsum('ij,ij->i', v0, np.cross(v1, v2)) / 6, minlength=inNumberOfMeshes)
+    areas = np.bincount(inMeshIndex, weights=0.5 * np.linalg.norm(np.cross(v1 - v0, v2 - v0), axis=1), minlength=inNumberOfMeshes)
+    return volumes, areas
+
+
+def triangle_areas(verts, faces):
+    '''Return the area of each triangle of a mesh'''
+    verts = np.asarray(verts, dtype=np.float64)
+    v0 = verts[faces[:, 0]]
+    return 0.5 * np.linalg.norm(np.cross(verts[faces[:, 1]] - v0, verts[faces[:, 2]] - v0), axis=1)
+
+
+def surface_area(verts, faces):
+    '''Return the area of a triangle mesh'''
+    return triangle_areas(verts, faces).sum()
+
+
+def transform_and_center(verts, faces, matrix):
+    '''Apply a transformation matrix to the vertices and move them so that the center of volume is at the origin.
+    Return the new vertices and the center (i.e. the location the object must have to stay in place)'''
+    verts = transform_vertices(verts, matrix)
+    center = volume_centroid(verts, faces)
+    return verts - center, center
+
+
+def read_and_center(inFilePath, inMatrix):
+    '''Read a mesh file, rotate/scale it with the matrix and center it. Return vertices, faces and center'''
+    verts, faces = read_mesh(inFilePath)
+    verts, center = transform_and_center(verts, faces, inMatrix)
+    return verts.astype(np.float32), np.ascontiguousarray(faces, dtype=np.int32), center
+
+
+# ------------------------------------------------------------------------
+#    Label volumes
+# ------------------------------------------------------------------------
+def read_label_volume(inFilePath):
+    '''Read a segmentation (label) volume indexed (z, y, x): .npy (memory mapped) or TIFF stack (requires tifffile)'''
+    suffix = Path(inFilePath).suffix.lower()
+    if suffix == '.npy':
+        volume = np.load(inFilePath, mmap_mode='r')
+    elif suffix in g_label_extensions:
+        try:
+            import tifffile
+        except ImportError:
+            raise ImportError("Reading TIFF stacks requires the 'tifffile' python package.") from None
+        volume = tifffile.imread(inFilePath)
+    else:
+        raise ValueError(f"{inFilePath}: unsupported label volume format '{suffix}'.")
+    volume = np.squeeze(volume)
+    if volume.ndim != 3:
+        raise ValueError(f"{inFilePath}: expected a 3D label volume, got {volume.ndim} dimensions.")
+    return volume
+
+
+def set_label_volume(inVolume):
+    '''Set the label volume meshed by mesh_label() and the workers'''
+    global g_label_volume
+    g_label_volume = inVolume
+
+
+def label_bounding_boxes(inVolume, inBackground=0):
+    '''Return the bounding box ((z0, y0, x0), (z1, y1, x1)), end excluded, of each label of the volume: {label: box}.
+    A single pass over the z slices, each read once (contiguous in a memory-mapped volume), to bound the memory used'''
+    # Extent of each label in each slice: label, z, y min, y max, x min, x max
+    extents = []
+    for z in range(inVolume.shape[0]):
+        plane = np.asarray(inVolume[z])
+        ys, xs = np.nonzero(plane != inBackground)
+        if len(ys) == 0:
+            continue
+        values = plane[ys, xs]
+        order = np.argsort(values, kind='stable')
+        values, ys, xs = values[order], ys[order], xs[order]
+        starts = np.flatnonzero(np.r_[True, values[1:] != values[:-1]])
+        extents.append(np.stack([values[starts].astype(np.int64), np.full(len(starts), z),
+                                 np.minimum.reduceat(ys, starts), np.maximum.reduceat(ys, starts),
+                                 np.minimum.reduceat(xs, starts), np.maximum.reduceat(xs, starts)], axis=1))
+    if not extents:
+        return {}
+    extents = np.concatenate(extents)
+    # Merge the extents of each label across the slices (arrays sized by the labels present, not by their values)
+    labels, index = np.unique(extents[:, 0], return_inverse=True)
+    lows = np.full((len(labels), 3), np.iinfo(np.int64).max, dtype=np.int64)
+    highs = np.full((len(labels), 3), -1, dtype=np.int64)
+    for axis, (low, high) in enumerate(((1, 1), (2, 3), (4, 5))):
+        np.minimum.at(lows[:, axis], index, extents[:, low])
+        np.maximum.at(highs[:, axis], index, extents[:, high] + 1)
+    return {label: (tuple(low), tuple(high)) for label, low, high in zip(labels.tolist(), lows.tolist(), highs.tolist())}
+
+
+def voxel_surface(inMask):
+    '''Vectorized extraction of the boundary faces of a binary volume (z, y, x). Return the vertices (voxel corners, in voxels)
+    and the faces (2 triangles per boundary voxel face, oriented outwards)'''
+    mask = np.pad(inMask, 1)
+    quads = []
+    for axis in range(3):
+        b_axis, c_axis = (axis + 1) % 3, (axis + 2) % 3
+        # Change of value between consecutive voxels: face on the plane between them
+        lower = np.take(mask, range(mask.shape[axis] - 1), axis=axis)
+        upper = np.take(mask, range(1, mask.shape[axis]), axis=axis)
+        for faces_out, flip in ((lower & ~upper, False), (upper & ~lower, True)):
+            index = np.argwhere(faces_out)
+            if len(index) == 0:
+                continue
+            # Position of the plane on the axis, corners in the order giving a normal along +axis
+            index[:, axis] += 1
+            corners = np.repeat(index[:, None, :], 4, axis=1)
+            corners[:, 1, b_axis] += 1
+            corners[:, 2, b_axis] += 1
+            corners[:, 2, c_axis] += 1
+            corners[:, 3, c_axis] += 1
+            quads.append(corners[:, ::-1] if flip else corners)
+    if not quads:
+        return np.zeros((0, 3), dtype=np.float32), np.zeros((0, 3), dtype=np.int32)
+    corners = np.concatenate(quads)
+    # Merge the corners shared by several faces
+    verts, index = np.unique(corners.reshape(-1, 3), axis=0, return_inverse=True)
+    index = index.reshape(-1, 4)
+    faces = np.concatenate([index[:, [0, 1, 2]], index[:, [0, 2, 3]]])
+    # Undo the padding
+    return (verts - 1).astype(np.float32), faces.astype(np.int32)
+
+
+def label_surface(inMask):
+    '''Surface of a binary volume (z, y, x) in voxels: marching cubes when scikit-image is available, boundary voxel faces otherwise'''
+    try:
+        from skimage.measure import marching_cubes
+    except ImportError:
+        return voxel_surface(inMask)
+    verts, faces, _, _ = marching_cubes(np.pad(inMask, 1).astype(np.uint8), level=0.5, allow_degenerate=False)
+    return (verts - 1).astype(np.float32), faces.astype(np.int32)
+
+
+def mesh_label(inLabel, inBox, inVoxelSize, inMatrix):
+    '''Mesh one label of the label volume (see set_label_volume): crop its bounding box, extract its surface,
+    scale it to µm with the voxel size (x, y, z), apply the transformation matrix and center it. Return vertices, faces and center'''
+    low, high = inBox
+    mask = np.asarray(g_label_volume[low[0]:high[0], low[1]:high[1], low[2]:high[2]]) == inLabel
+    verts, faces = label_surface(mask)
+    # (z, y, x) voxels to (x, y, z) µm: swapping axes mirrors the mesh, the faces are flipped to keep them outwards
+    verts = (verts + low)[:, ::-1] * np.asarray(inVoxelSize, dtype=np.float32)
+    faces = np.ascontiguousarray(faces[:, ::-1])
+    verts, center = transform_and_center(verts, faces, inMatrix)
+    return verts.astype(np.float32), faces, center
+
+
+# ------------------------------------------------------------------------
+#    Contacts
+# ------------------------------------------------------------------------
+def overlapping_boxes(lows, highs, inTolerance=0.0, chunk_size=4096):
+    '''Sweep and prune: return the (n, 2) array of the pairs of indices (i < j) of the axis-aligned boxes (lows, highs: (n, 3))
+    that overlap or are closer than inTolerance. The boxes are swept along the axis where they spread the most'''
+    lows = np.asarray(lows, dtype=np.float64) - inTolerance / 2
+    highs = np.asarray(highs, dtype=np.float64) + inTolerance / 2
+    n = len(lows)
+    if n < 2:
+        return np.empty((0, 2), dtype=np.int64)
+    axis = np.argmax(np.ptp(lows + highs, axis=0))
+    order = np.argsort(lows[:, axis], kind='stable')
+    lows = lows[order]
+    highs = highs[order]
+    # Box k overlaps along the sweep axis the boxes k+1 to ends[k]-1, which start before it ends
+    ends = np.searchsorted(lows[:, axis], highs[:, axis], side='right')
+    counts = np.maximum(ends - np.arange(n) - 1, 0)
+    pairs = []
+    for start in range(0, n, chunk_size):
+        chunk_counts = counts[start:start + chunk_size]
+        total = chunk_counts.sum()
+        if total == 0:
+            continue
+        i = np.repeat(np.arange(start, start + len(chunk_counts)), chunk_counts)
+        j = i + 1 + np.arange(total) - np.repeat(np.cumsum(chunk_counts) - chunk_counts, chunk_counts)
+        # Keep the pairs overlapping along the 3 axes
+        keep = np.all((lows[j] <= highs[i]) & (lows[i] <= highs[j]), axis=1)
+        pairs.append(np.stack([order[i[keep]], order[j[keep]]], axis=1))
+    if not pairs:
+        return np.empty((0, 2), dtype=np.int64)
+    pairs = np.sort(np.concatenate(pairs), axis=1)
+    return pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
+
+def contact_areas(inPairIndex, inTriangles, inAreas, inNumberOfPairs):
+    '''Return the area of contact of each pair of meshes: the average over both meshes of the area of their triangles overlapping
+    the other mesh. inPairIndex: pair of each overlapping triangle, inTriangles: index of the triangle in inAreas, the areas of the
+    triangles of all the meshes. A triangle overlapping several triangles of the other mesh is counted once'''
+    if len(inTriangles) == 0:
+        return np.zeros(inNumberOfPairs)
+    keys = np.unique(np.asarray(inPairIndex, dtype=np.int64) * len(inAreas) + inTriangles)
+    return np.bincount(keys // len(inAreas), weights=inAreas[keys % len(inAreas)], minlength=inNumberOfPairs) / 2
+
+
+# ------------------------------------------------------------------------
+#    Worker processes
+# ------------------------------------------------------------------------
+def to_shared_array(arr):
+    '''Copy an array into a new shared memory block. Return the descriptor (name, shape, dtype) to retrieve it.
+    The block is owned by whoever reads it back with read_shared_array()'''
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    # The reader unlinks the block: stop the tracker of this process from unlinking it when the worker exits
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    shm.close()
+    return shm.name, arr.shape, arr.dtype.str
+
+
+def read_shared_array(inDescriptor):
+    '''Return a copy of an array stored in shared memory and free the block'''
+    name, shape, dtype = inDescriptor
+    shm = shared_memory.SharedMemory(name=name)
+    arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy()
+    shm.close()
+    shm.unlink()
+    return arr
+
+
+def free_shared_array(inDescriptor):
+    '''Free a shared memory block that will not be read'''
+    shm = shared_memory.SharedMemory(name=inDescriptor[0])
+    shm.close()
+    shm.unlink()
+
+
+def parse_to_shared_memory(inFilePath, inMatrix, inCacheDir='', inSignature=''):
+    '''Worker: read a mesh file, apply the transformation matrix, center it and hand over the arrays through shared memory.
+    The time spent reading is returned too. With a cache folder, the key is (file path, digest of its content) and a file already
+    in the cache is not parsed: its descriptors are None'''
+    start = time.perf_counter()
+    if inCacheDir:
+        digest = file_digest(inFilePath)
+        if cached_mesh_path(inCacheDir, digest, inSignature).exists():
+            return (inFilePath, digest), None, None, None, time.perf_counter() - start
+    verts, faces, center = read_and_center(inFilePath, inMatrix)
+    key = (inFilePath, digest) if inCacheDir else inFilePath
+    return key, to_shared_array(verts), to_shared_array(faces), center, time.perf_counter() - start
+
+
+def mesh_label_to_shared_memory(inLabel, inBox, inVoxelSize, inMatrix):
+    '''Worker: mesh one label of the label volume and hand over the arrays through shared memory. The time spent is returned too'''
+    start = time.perf_counter()
+    verts, faces, center = mesh_label(inLabel, inBox, inVoxelSize, inMatrix)
+    return inLabel, to_shared_array(verts), to_shared_array(faces), center, time.perf_counter() - start
+
+
+# ------------------------------------------------------------------------
+#    Cache of processed meshes
+# ------------------------------------------------------------------------
+def file_key(inFilePath):
+    '''Identify the version of a file without reading it: resolved path, size and modification time'''
+    stat = os.stat(inFilePath)
+    return f"{Path(inFilePath).resolve().as_posix()}|{stat.st_size}|{stat.st_mtime_ns}"
+
+
+def file_digest(inFilePath, chunk_size=1 << 20):
+    '''SHA-1 of the content of a file: the same for a copy of the file, wherever it is'''
+    digest = hashlib.sha1()
+    with open(inFilePath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cached_mesh_path(inCacheDir, inDigest, inSignature):
+    '''Path of the cache entry of a file (digest of its content, see file_digest()) processed with the parameters described by
+    the signature. Copies of a file share their entry, on the same or another machine.'''
+    key = hashlib.sha1(f"{inDigest}|{inSignature}".encode('utf-8')).hexdigest()
+    return Path(inCacheDir, key[:2], key).with_suffix('.npz')
+
+
+class DigestIndex:
+    '''Digests of the files already hashed, keyed by file_key() and stored in the cache folder: a file that did not change since it
+    was hashed is looked up in the cache without being read'''
+
+    def __init__(self, inCacheDir):
+        self.path = Path(inCacheDir, 'digests.json')
+        self.digests = self.load()
+        self.changed = False
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, inFilePath):
+        '''Return the digest of a file if known, None otherwise (the file is not read)'''
+        return self.digests.get(file_key(inFilePath))
+
+    def put(self, inFilePath, inDigest):
+        key = file_key(inFilePath)
+        if self.digests.get(key) != inDigest:
+            self.digests[key] = inDigest
+            self.changed = True
+
+    def digest(self, inFilePath):
+        '''Return the digest of a file, read and hashed if not known'''
+        digest = self.get(inFilePath)
+        if digest is None:
+            digest = file_digest(inFilePath)
+            self.put(inFilePath, digest)
+        return digest
+
+    def save(self):
+        '''Write the digests, merged with the ones written meanwhile by other imports sharing the cache'''
+        if not self.changed:
+            return
+        digests = self.load()
+        digests.update(self.digests)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f"{self.path.stem}.{os.getpid()}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(digests, f)
+        os.replace(tmp_path, self.path)
+        self.digests = digests
+        self.changed = False
+
+
+def load_cached_mesh(inCachePath):
+    '''Return the arrays stored in a cache entry as a dict, None if there is no (readable) entry'''
+    try:
+        with np.load(inCachePath) as data:
+            return {k: data[k] for k in data.files}
+    except (OSError, ValueError, EOFError):
+        return None
+
+
+def save_cached_mesh(inCachePath, **arrays):
+    '''Store arrays in a compressed cache entry. The file is written aside then renamed, so that concurrent readers never see a partial entry'''
+    inCachePath = Path(inCachePath)
+    inCachePath.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = inCachePath.with_name(f"{inCachePath.stem}.{os.getpid()}.tmp.npz")
+    np.savez_compressed(tmp_path, **arrays)
+    os.replace(tmp_path, inCachePath)
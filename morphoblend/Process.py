@@ -2,11 +2,11 @@ import re
 import csv
 
 import bpy
+import numpy as np
 from bpy.props import (BoolProperty, EnumProperty,
                        IntVectorProperty, PointerProperty, StringProperty)
 
-from .Quantify import volume_and_area_from_object
-from .Utilities import (apply_modifiers, assign_material, col_hierarchy,
+from .Utilities import (apply_modifiers, assign_material, cell_registry, col_hierarchy, is_packed,
                         create_materials_palette,
                         move_obj_to_subcoll, unique_colls_names_list, make_collection)
 
@@ -201,25 +201,21 @@ class MORPHOBLEND_OT_SelectOnVolume(bpy.types.Operator):
             while filt_coll.objects:
                 filt_coll.objects.unlink(filt_coll.objects[0])
 
-        k = 0
+        registry = cell_registry()
         if _apply_to_all:
-            # Parse all objects of the scene
-            for obj in bpy.context.scene.objects:
-                if obj.type == 'MESH':
-                    (o_vol, o_area) = volume_and_area_from_object(obj)
-                    if _min_vol <= o_vol <= _max_vol:
-                        # Make a COPY (SymLink) of the object to the Filtered list
-                        filt_coll.objects.link(obj)
-                        k += 1
+            # Parse all cells of the scene
+            rows = np.arange(len(registry.cells))
         else:
             # Parse selection
-            for obj in bpy.context.selected_objects:
-                if obj.type == 'MESH':
-                    (o_vol, o_area) = volume_and_area_from_object(obj)
-                    if _min_vol <= o_vol <= _max_vol:
-                        # Make a COPY (SymLink) of the object to the Filtered list
-                        filt_coll.objects.link(obj)
-                        k += 1
+            rows = registry.rows([obj.name for obj in bpy.context.selected_objects if obj.type == 'MESH' and not is_packed(obj)])
+        # Volumes of all the cells at once
+        registry.measure(rows)
+        volumes = registry.cells['volume'][rows]
+        selected = rows[(volumes >= _min_vol) & (volumes <= _max_vol)]
+        for name in registry.cells['name'][selected]:
+            # Make a COPY (SymLink) of the object to the Filtered list
+            filt_coll.objects.link(bpy.data.objects[name])
+        k = len(selected)
 
         # Deselect all objects and select the ones filtered
         bpy.ops.object.select_all(action='DESELECT')
@@ -227,7 +223,13 @@ class MORPHOBLEND_OT_SelectOnVolume(bpy.types.Operator):
             obj.select_set(True)
 
         info_mess = f"{str(k)} object(s) identified!"
-        self.report({'INFO'}, info_mess)
+        # Packed cells are not objects: they are not filtered
+        candidates = bpy.context.scene.objects if _apply_to_all else bpy.context.selected_objects
+        packed = [obj.name for obj in candidates if is_packed(obj)]
+        if packed:
+            self.report({'WARNING'}, f"{info_mess} Packed time points skipped ({', '.join(packed)}): unpack them (Alter) to filter their cells")
+        else:
+            self.report({'INFO'}, info_mess)
         return {'FINISHED'}
 
 
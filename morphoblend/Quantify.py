@@ -7,8 +7,8 @@ from bpy.props import (CollectionProperty, EnumProperty,
                        IntProperty, PointerProperty, StringProperty, BoolProperty)
 
 from .Utilities import (Display2D_LUT_image, assign_material, create_materials_palette,
-                        get_collection, get_global_coordinates,
-                        volume_and_area_from_object, scaled_dimensions)
+                        cell_registry, g_metric_cache, get_collection, get_global_coordinates, is_packed, packed_cell_metrics,
+                        volume_and_area_from_object, volumes_and_areas_from_objects, scaled_dimensions)
 
 
 # ------------------------------------------------------------------------
@@ -84,10 +84,24 @@ class MORPHOBLEND_OT_Morphometric(bpy.types.Operator):
             objects = bpy.context.scene.objects
         else:
             objects = bpy.context.selected_objects
+        # Volume & area of all the cells at once
+        registry = cell_registry()
+        cells = [obj for obj in objects if obj.type == 'MESH' and not is_packed(obj)]
+        registry.measure(registry.rows([obj.name for obj in cells]))
+        scale = bpy.context.scene.unit_settings.scale_length
         for obj in objects:
             bpy.context.view_layer.objects.active = obj
             obj_line = []
-            if obj.type == 'MESH':
+            if is_packed(obj):
+                # All the cells of the time point at once, from the arrays of the mesh
+                obj_coll = get_collection(obj).name.replace(' ', '_')
+                for name, (vol_obj, area_obj, dims, obj_center) in packed_cell_metrics(obj).items():
+                    obj_line = [name.replace(' ', '_'), '-', obj_coll]
+                    obj_line.extend([f'{vol_obj:.3f}', f'{area_obj:.3f}', f'{vol_obj/area_obj:.3f}'])
+                    obj_line.extend([f'{dims[0]:.3f}', f'{dims[1]:.3f}', f'{dims[2]:.3f}'])
+                    obj_line.extend([f'{obj_center[0]:.3f}', f'{obj_center[1]:.3f}', f'{obj_center[2]:.3f}'])
+                    bpy.ops.morphoblend.list_action(list_item=self.format_line(obj_line), action='ADD')
+            elif obj.type == 'MESH':
                 obj.name.replace(' ', '_')
                 obj_line.append(obj.name)
                 if(obj.parent):
@@ -95,16 +109,27 @@ class MORPHOBLEND_OT_Morphometric(bpy.types.Operator):
                     obj_line.append(obj.parent.name)
                 else:
                     obj_line.append('-')
-                obj_coll = get_collection(bpy.data.objects[obj.name]).name.replace(' ', '_')
+                row = registry.row(obj.name)
+                if row is None:
+                    # Not a registered cell: measure it directly
+                    obj_coll = get_collection(obj).name.replace(' ', '_')
+                    vol_obj, area_obj = volume_and_area_from_object(obj)
+                    obj_center = get_global_coordinates(obj)
+                else:
+                    cell = registry.cells[row]
+                    obj_coll = str(cell['collection']).replace(' ', '_')
+                    vol_obj, area_obj = cell['volume'], cell['area']
+                    obj_center = cell['center']
                 obj_line.append(obj_coll)
-                vol_obj, area_obj = volume_and_area_from_object(obj)
                 obj_line.extend([f'{vol_obj:.3f}', f'{area_obj:.3f}', f'{vol_obj/area_obj:.3f}'])
                 dims = scaled_dimensions(obj)
                 obj_line.extend([f'{dims[0]:.3f}', f'{dims[1]:.3f}', f'{dims[2]:.3f}'])
-                obj_center = get_global_coordinates(obj) * bpy.context.scene.unit_settings.scale_length
+                obj_center = obj_center * scale
                 obj_line.extend([f'{obj_center[0]:.3f}', f'{obj_center[1]:.3f}', f'{obj_center[2]:.3f}'])
                 print(obj_line)
                 bpy.ops.morphoblend.list_action(list_item=self.format_line(obj_line), action='ADD')
+        stats = g_metric_cache.stats()
+        print(f"Metric cache: {stats['entries']} objects, {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%})")
         return{'FINISHED'}
 
 
@@ -240,14 +265,12 @@ class MORPHOBLEND_OT_ColorizeMetric(bpy.types.Operator):
         vol_array = []
         area_array = []
 
-        # Parse all selected
-        for obj in bpy.context.selected_objects:
-            bpy.context.view_layer.objects.active = obj
-            if obj.type == 'MESH':
-                vol_obj, area_obj = volume_and_area_from_object(obj)
-                names_array.append(obj.name)
-                vol_array.append(vol_obj)
-                area_array.append(area_obj)
+        # Parse all selected. Cells of packed time points keep their color
+        cells = [obj for obj in bpy.context.selected_objects if obj.type == 'MESH' and not is_packed(obj)]
+        for obj, (vol_obj, area_obj) in zip(cells, volumes_and_areas_from_objects(cells)):
+            names_array.append(obj.name)
+            vol_array.append(vol_obj)
+            area_array.append(area_obj)
         if self.chosen_metric == 'VOLUME':
             metric_to_map = vol_array
         if self.chosen_metric == 'AREA':
@@ -5,7 +5,7 @@ from bpy.props import BoolProperty, PointerProperty, EnumProperty, StringPropert
 
 from .Utilities import (unique_colls_names_list,
                         col_hierarchy,
-                        collections_from_pattern,
+                        time_point_index,
                         show_active_tp,
                         collection_navigator,
                         hide_display)
@@ -66,7 +66,7 @@ class MORPHOBLEND_OT_NextTimePoint(bpy.types.Operator):
     def execute(self, context):
         analyze_op = context.scene.render_tool
         # Get all TP collections at the topmost level
-        all_tp_cols = collections_from_pattern(analyze_op.tp_pattern)
+        all_tp_cols = time_point_index(analyze_op.tp_pattern)
         # Retrieve the currently active TP collection and make it the only visible
         currentTPcoll = show_active_tp(context)
         # Get the next time point and display it
@@ -93,7 +93,7 @@ class MORPHOBLEND_OT_PreviousTimePoint(bpy.types.Operator):
     def execute(self, context):
         render_op = context.scene.render_tool
         # Get all TP collections at the topmost level
-        all_tp_cols = collections_from_pattern(render_op.tp_pattern)
+        all_tp_cols = time_point_index(render_op.tp_pattern)
         # Retrieve the currently active TP collection and make it the only visible
         currentTPcoll = show_active_tp(context)
         # Get the previous time point and display it
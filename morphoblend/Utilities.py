@@ -1,3 +1,6 @@
+import hashlib
+import os
+from collections import OrderedDict
 from math import radians, sqrt
 from pathlib import Path
 from random import randrange
@@ -10,17 +13,29 @@ import blf
 import bmesh
 import bpy
 import gpu
+from bpy.app.handlers import persistent
 import numpy as np
 from gpu_extras.batch import batch_for_shader
 from mathutils import Matrix, Vector
+from mathutils.bvhtree import BVHTree
 from itertools import tee, islice, chain
 
+from .Mesh_io import contact_areas, overlapping_boxes, transform_vertices, triangle_areas, triangulate_loops, volume_centroid, volumes_and_areas
+
 # ------------------------------------------------------------------------
 #    global variables
 # ------------------------------------------------------------------------
 
-# Cache for the volume and area measurements
-g_cache_vol_area = {}
+# Maximum number of objects kept in the cache of the measurements
+g_metric_cache_size = 100000
+# Margin of the bounding boxes of the cells when looking for contacts, relative to the median size of the boxes
+g_contact_tolerance = 0.01
+# Packed time points: face attribute holding the id of the cell of each face and object property listing the names of the cells (by id)
+g_cell_id_attribute = 'cell_id'
+g_packed_names_key = 'morphoblend_cells'
+# Time point property storing the metrics of its cells: volume, area, dimensions (X, Y, Z) and center (X, Y, Z) per row
+g_metrics_key = 'morphoblend_metrics'
+g_metric_fields = 8
 
 
 # ------------------------------------------------------------------------
@@ -109,8 +124,120 @@ def assign_material(inObj, inMatPalette, color_index=0, rand_color=False):
 # ------------------------------------------------------------------------
 #    Collections
 # ------------------------------------------------------------------------
+class CollectionIndex:
+    '''Index of the hierarchy of the collections of the scene (parent, depth and time point of each collection), built in a
+    single walk and kept until the collections change'''
+
+    def __init__(self):
+        self.stale = True
+        self.scene = None
+        self.n_collections = -1
+
+    def build(self):
+        scene = bpy.context.scene
+        root = scene.collection
+        # (parent, child, depth) of each link, in the order of a depth-first walk
+        self.links = []
+        self.parents = {}
+        self.by_name = {}
+        self.depths = {}
+        self.time_points = {}
+        stack = [(child, root, 1, child) for child in reversed(root.children)]
+        while stack:
+            coll, parent, depth, time_point = stack.pop()
+            self.links.append((parent, coll, depth))
+            self.parents.setdefault(coll.name, parent)
+            self.by_name.setdefault(coll.name, coll)
+            self.depths.setdefault(coll.name, depth)
+            self.time_points.setdefault(coll.name, time_point)
+            stack.extend((child, coll, depth + 1, time_point) for child in reversed(coll.children))
+        self.top_level = list(root.children)
+        self.hierarchies = {}
+        self.unique_names = None
+        self.time_point_indexes = {}
+        self.stale = False
+        self.scene = scene.name
+        self.n_collections = len(bpy.data.collections)
+
+    def hierarchy(self, levels):
+        '''Return {parent: [children]} for the collections down to a depth, as col_hierarchy does'''
+        if levels not in self.hierarchies:
+            level_lookup = {}
+            for parent, coll, depth in self.links:
+                if depth <= levels:
+                    level_lookup.setdefault(parent, []).append(coll)
+            self.hierarchies[levels] = level_lookup
+        return self.hierarchies[levels]
+
+
+g_collection_index = CollectionIndex()
+
+
+def collection_index():
+    '''Return the index of the collections of the scene, rebuilt if the collections changed'''
+    scene = bpy.context.scene
+    if g_collection_index.stale or g_collection_index.scene != scene.name or g_collection_index.n_collections != len(bpy.data.collections):
+        g_collection_index.build()
+    return g_collection_index
+
+
+@persistent
+def collection_index_depsgraph_update(scene, depsgraph):
+    '''Flag the index for rebuild when collections were added, removed, renamed or moved'''
+    if depsgraph.id_type_updated('COLLECTION'):
+        g_collection_index.stale = True
+
+
+@persistent
+def collection_index_load_post(dummy):
+    g_collection_index.stale = True
+
+
+@persistent
+def collection_index_undo_post(dummy):
+    '''Undo and redo rebuild the data of the file: the collections held by the index (and the time points) are no longer valid'''
+    g_collection_index.stale = True
+
+
+def natural_key(inName):
+    '''Sort key ordering the numbers in a name by value: t2 comes before t10'''
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', inName)]
+
+
+class TimePoints:
+    '''Time point collections in natural order. Behaves as a read-only list whose index() is a dictionary lookup'''
+
+    def __init__(self, inCollections):
+        self.collections = sorted(inCollections, key=lambda col: natural_key(col.name))
+        self.positions = {col.name: k for k, col in enumerate(self.collections)}
+
+    def __len__(self):
+        return len(self.collections)
+
+    def __getitem__(self, inKey):
+        return self.collections[inKey]
+
+    def __iter__(self):
+        return iter(self.collections)
+
+    def index(self, inColl):
+        if inColl.name not in self.positions:
+            raise ValueError(f"{inColl.name} is not a time point")
+        return self.positions[inColl.name]
+
+
+def time_point_index(in_pattern):
+    ''' Returns the time point collections (1st level) which name matches a pattern, in natural order. Cached per pattern'''
+    index = collection_index()
+    if in_pattern not in index.time_point_indexes:
+        index.time_point_indexes[in_pattern] = TimePoints([col for col in index.top_level if re.match(in_pattern, col.name) is not None])
+    return index.time_point_indexes[in_pattern]
+
+
 def col_hierarchy(root_col, levels=1):
     '''Return hierarchy of the collections as dict. Starts from root. Levels specifies how deep to recurse.'''
+    if root_col == bpy.context.scene.collection:
+        return collection_index().hierarchy(levels)
     level_lookup = {}
 
     def recurse(root_col, parent, depth):
@@ -133,6 +260,8 @@ def traverse_tree(t):
 
 def parent_lookup(coll):
     '''Retrieve parents of a collection'''
+    if coll == bpy.context.scene.collection:
+        return collection_index().parents
     parent_lookup = {}
     for coll in traverse_tree(coll):
         for c in coll.children.keys():
@@ -142,9 +271,12 @@ def parent_lookup(coll):
 
 def get_parent(coll):
     ''' Return the parent of a collection '''
-    # Get parents of all collections in the scene
-    coll_parents = parent_lookup(bpy.context.scene.collection)
-    return coll_parents.get(coll.name)
+    return collection_index().parents.get(coll.name)
+
+
+def get_time_point(coll):
+    ''' Return the time point (1st level collection) containing a collection, None if not in the scene'''
+    return collection_index().time_points.get(coll.name)
 
 
 def get_collection(obj):
@@ -159,7 +291,7 @@ def get_collection(obj):
 def show_active_tp(context):
     '''Get the last active time point collection and make it the only one visible in viewport and renderer'''
     analyze_op = context.scene.render_tool
-    all_tp_cols = collections_from_pattern(analyze_op.tp_pattern)
+    all_tp_cols = time_point_index(analyze_op.tp_pattern)
     current_col = context.collection
     if re.match(analyze_op.tp_pattern, current_col.name):
         currentTPcoll = current_col
@@ -177,7 +309,8 @@ def show_active_tp(context):
 
 
 def collection_navigator(inCollList, inCurrentColl, direction):
-    '''Returns the next/previous time point collection  relative to the one passed in, return FALSE if error'''
+    '''Returns the next/previous time point collection  relative to the one passed in, return FALSE if error.
+    With the TimePoints of time_point_index(), the lookup of the current time point is immediate'''
     # Get index of the timepoint in the hierarchy
     tpcol_index = inCollList.index(inCurrentColl)
     if direction == 'next':
@@ -208,18 +341,8 @@ def hide_display(currentTPcoll, next_tp):
 
 
 def collections_from_pattern(in_pattern):
-    ''' Returns a sorted list of all collections which name matches a pattern'''
-    # list of all collections at 1st level
-    scn_col = bpy.context.scene.collection  # Root collection
-    root_cols = col_hierarchy(scn_col, levels=1)
-    all_cols = [k for k in root_cols.values()][0]
-    # Only keep collections that are time points
-    all_tp_cols = {}
-    for col in all_cols:
-        if re.match(in_pattern, col.name) is not None:
-            all_tp_cols[col.name] = col
-    sorted_all_tp_cols = dict(sorted(all_tp_cols.items(), key=lambda i: i[0].lower()))
-    return list(sorted_all_tp_cols.values())
+    ''' Returns a list of all time point collections which name matches a pattern, in natural order (t2 before t10)'''
+    return list(time_point_index(in_pattern))
 
 
 def make_collection(collection_name, parent_collection):
@@ -294,41 +417,53 @@ def previous_and_next(some_iterable):
 
 def unique_colls_names_list():
     ''' Return a list of unique collection names'''
-    # Retrieve hiearchy of all collection and their parents
-    cols_tree = col_hierarchy(bpy.context.scene.collection, levels=9)
-    all_cols = {i: k for k, v in cols_tree.items() for i in v}
-
-    # Parse all collections and process the ones matching the pattern
-    names_elements = []
-    for col in all_cols:
-        name_element = re.split('\s+|_', col.name)
-        names_elements.extend(name_element)
-    # return a sorted list of unique names
-    return sorted(list(set(names_elements)), key=lambda i: i[0].lower())
+    index = collection_index()
+    if index.unique_names is None:
+        # Retrieve hiearchy of all collection and their parents
+        cols_tree = index.hierarchy(9)
+        all_cols = {i: k for k, v in cols_tree.items() for i in v}
+
+        # Parse all collections and process the ones matching the pattern
+        names_elements = []
+        for col in all_cols:
+            name_element = re.split('\s+|_', col.name)
+            names_elements.extend(name_element)
+        # return a sorted list of unique names
+        index.unique_names = sorted(list(set(names_elements)), key=lambda i: i[0].lower())
+    return index.unique_names
 
 # ------------------------------------------------------------------------
 #    Files and folders
 # ------------------------------------------------------------------------
 
-def number_of_file_to_import(folder_path, allowed_extension, include_subfolders=True):
+def scan_mesh_files(folder_path, allowed_extension, include_subfolders=True):
+    '''Walk the folder once and return the list of (subfolder, file path, size in bytes, modification time) of the files with an allowed extension,
+    sorted by subfolder then file. The subfolder is relative to folder_path ('.' for the folder itself).
+    Extensions are compared case-insensitively: '.ply' matches 'cell.PLY'.'''
     folder_path = Path(folder_path)
     if not folder_path.is_dir():
         raise ValueError("The provided path is not a directory.")
+    extensions = {ext.lower() for ext in allowed_extension}
+    mesh_files = []
+    folders = [folder_path]
+    while folders:
+        folder = folders.pop()
+        subfolder = folder.relative_to(folder_path).as_posix()
+        # scandir returns the type of each entry without an extra stat: only the files kept are stat'ed, once
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if include_subfolders:
+                        folders.append(Path(entry.path))
+                elif os.path.splitext(entry.name)[1].lower() in extensions and entry.is_file():
+                    stat = entry.stat()
+                    mesh_files.append((subfolder, Path(entry.path).as_posix(), stat.st_size, stat.st_mtime))
+    return sorted(mesh_files)
 
-    # Initialize count
-    file_count = 0
-
-    # Iterate through all files and subdirectories recursively if include_subfolders is True
-    if include_subfolders:
-        for file_path in folder_path.rglob("*"):
-             if file_path.is_file() and file_path.suffix in allowed_extension:
-                file_count += 1
-    else:
-        for file_path in folder_path.glob("*"):
-            if file_path.is_file() and file_path.suffix in allowed_extension:
-                file_count += 1
 
-    return file_count
+def number_of_file_to_import(folder_path, allowed_extension, include_subfolders=True):
+    '''Return the number of files with an allowed extension in the folder'''
+    return len(scan_mesh_files(folder_path, allowed_extension, include_subfolders))
 
 
 # ------------------------------------------------------------------------
@@ -386,21 +521,204 @@ def distance2D(ref=(0, 0, 0), point=(0, 0, 0), plane_def=(True, False, True)):
 
 def volume_and_area_from_object(inObj):
     ''' Return the scaled volume & area for an object'''
-    # If object is in the cache, retrieve the values
-    global g_cache_vol_area
-    if inObj in g_cache_vol_area.keys():
-        return g_cache_vol_area[inObj][0], g_cache_vol_area[inObj][1]
-    else:  # Not in the cache, compute.
-        bm = bmesh.new()   # create an empty BMesh
-        bm = bmesh_copy_from_object(inObj, apply_modifiers=True)
-        volume = bm.calc_volume()
-        area = sum(f.calc_area() for f in bm.faces)
-        bm.free()
-        scaled_volume = volume * bpy.context.scene.unit_settings.scale_length ** 3
-        scaled_area = area * bpy.context.scene.unit_settings.scale_length ** 2
+    return volumes_and_areas_from_objects([inObj])[0]
+
+
+def volumes_and_areas_from_objects(inObjects):
+    '''Return the scaled volume & area of each object (list of (volume, area)). The triangles of all the objects not in the cache
+    are gathered in arrays and measured in a single pass'''
+    results = {}
+    to_compute = []
+    fingerprints = {}
+    for obj in dict.fromkeys(inObjects):
+        fingerprints[obj] = g_metric_cache.fingerprint(obj)
+        cached = g_metric_cache.get(obj, 'vol_area', fingerprints[obj])
+        if cached is None:
+            to_compute.append(obj)
+        else:
+            results[obj] = cached
+    if to_compute:
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+        all_verts = []
+        all_tris = []
+        mesh_index = []
+        n_verts = 0
+        for k, obj in enumerate(to_compute):
+            verts, tris = world_mesh_arrays(obj, depsgraph)
+            all_verts.append(verts)
+            all_tris.append(tris + n_verts)
+            mesh_index.append(np.full(len(tris), k, dtype=np.int64))
+            n_verts += len(verts)
+        volumes, areas = volumes_and_areas(np.concatenate(all_verts), np.concatenate(all_tris), np.concatenate(mesh_index), len(to_compute))
+        scale = bpy.context.scene.unit_settings.scale_length
         # Cache the results
-        g_cache_vol_area[inObj] = (abs(scaled_volume), abs(scaled_area))
-        return abs(scaled_volume), abs(scaled_area)
+        for obj, volume, area in zip(to_compute, volumes, areas):
+            results[obj] = (abs(volume * scale ** 3), abs(area * scale ** 2))
+            g_metric_cache.put(obj, 'vol_area', results[obj], fingerprints[obj])
+    return [results[obj] for obj in inObjects]
+
+
+def world_bounding_boxes(inObjects):
+    '''Return the lower and upper corners ((n, 3) arrays, NOT scaled) of the world bounding boxes of objects, modifiers included'''
+    if not inObjects:
+        return np.empty((0, 3)), np.empty((0, 3))
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    corners = np.array([obj.evaluated_get(depsgraph).bound_box for obj in inObjects], dtype=np.float64)
+    matrices = np.array([obj.matrix_world for obj in inObjects], dtype=np.float64)
+    corners = np.einsum('nij,nkj->nki', matrices[:, :3, :3], corners) + matrices[:, None, :3, 3]
+    return corners.min(axis=1), corners.max(axis=1)
+
+
+class PackedCell:
+    '''A cell of a packed object, measured like a cell object: its name, the packed object and its cell id. Its collection is the
+    one of the packed object (see get_collection())'''
+    __slots__ = ('name', 'packed', 'cell_id')
+
+    def __init__(self, inPacked, inCellId, inName):
+        self.packed = inPacked
+        self.cell_id = inCellId
+        self.name = inName
+
+    @property
+    def users_collection(self):
+        return self.packed.users_collection
+
+
+def contact_cells(inObjects):
+    '''Return the cells of objects whose contacts can be measured: the mesh objects and the cells of the packed objects (PackedCell).
+    Cells already given as PackedCell are kept'''
+    cells = []
+    for obj in inObjects:
+        if isinstance(obj, PackedCell):
+            cells.append(obj)
+        elif is_packed(obj):
+            names = packed_cell_names(obj)
+            cell_ids = np.empty(len(obj.data.polygons), dtype=np.int32)
+            obj.data.attributes[g_cell_id_attribute].data.foreach_get('value', cell_ids)
+            cells.extend(PackedCell(obj, int(cell_id), names[cell_id]) for cell_id in np.unique(cell_ids) if names[cell_id])
+        elif obj.type == 'MESH':
+            cells.append(obj)
+    return cells
+
+
+def packed_cell_triangles(inObj):
+    '''Return the vertices (in world coordinates) of a packed object and the triangles of each of its cells: {cell id: (k, 3) array}'''
+    me = inObj.data
+    verts, tris = mesh_to_arrays(me)
+    verts = transform_vertices(verts, np.array(inObj.matrix_world))
+    tri_faces = np.empty(len(me.loop_triangles), dtype=np.int32)
+    me.loop_triangles.foreach_get('polygon_index', tri_faces)
+    cell_ids = np.empty(len(me.polygons), dtype=np.int32)
+    me.attributes[g_cell_id_attribute].data.foreach_get('value', cell_ids)
+    tri_cells = cell_ids[tri_faces]
+    # Triangles grouped by cell: the faces of a cell are a range of the sorted triangles
+    order = np.argsort(tri_cells, kind='stable')
+    ids, starts = np.unique(tri_cells[order], return_index=True)
+    return verts, {int(cell_id): tris[group] for cell_id, group in zip(ids, np.split(order, starts[1:]))}
+
+
+def packed_cells_by_object(inCells):
+    '''Group the indices of the packed cells of a list of cells by packed object: {packed object name: [index]}'''
+    groups = {}
+    for k, cell in enumerate(inCells):
+        if isinstance(cell, PackedCell):
+            groups.setdefault(cell.packed.name, []).append(k)
+    return groups
+
+
+def cell_bounding_boxes(inCells):
+    '''Return the lower and upper corners ((n, 3) arrays, NOT scaled) of the world bounding boxes of cells (objects or PackedCell)'''
+    lows = np.empty((len(inCells), 3))
+    highs = np.empty((len(inCells), 3))
+    objects = [k for k, cell in enumerate(inCells) if not isinstance(cell, PackedCell)]
+    if objects:
+        lows[objects], highs[objects] = world_bounding_boxes([inCells[k] for k in objects])
+    # The arrays of a packed object are read once for all its cells
+    for indices in packed_cells_by_object(inCells).values():
+        verts, cell_tris = packed_cell_triangles(inCells[indices[0]].packed)
+        for k in indices:
+            corners = verts[cell_tris[inCells[k].cell_id].ravel()]
+            lows[k], highs[k] = corners.min(axis=0), corners.max(axis=0)
+    return lows, highs
+
+
+def cell_digests(inCells):
+    '''Return the digest of the geometry of each cell (objects or PackedCell), stable across sessions: {name: digest}'''
+    digests = {cell.name: geometry_digest(cell) for cell in inCells if not isinstance(cell, PackedCell)}
+    for indices in packed_cells_by_object(inCells).values():
+        verts, cell_tris = packed_cell_triangles(inCells[indices[0]].packed)
+        for k in indices:
+            cell_verts = verts[np.unique(cell_tris[inCells[k].cell_id])]
+            digests[inCells[k].name] = hashlib.blake2b(cell_verts.tobytes(), digest_size=8).hexdigest()
+    return digests
+
+
+def contact_candidates(inObjects, inTolerance=None):
+    '''Return the pairs of cells (mesh objects, cells of the packed objects) whose world bounding boxes overlap: the only ones that
+    can touch. The boxes are grown by inTolerance (default: g_contact_tolerance of their median size)'''
+    cells = contact_cells(inObjects)
+    lows, highs = cell_bounding_boxes(cells)
+    if inTolerance is None:
+        inTolerance = g_contact_tolerance * np.median(highs - lows) if len(cells) else 0.0
+    return [(cells[i], cells[j]) for i, j in overlapping_boxes(lows, highs, inTolerance)]
+
+
+class ContactGeometry:
+    '''Geometry of the cells of a time point used to measure their contacts: the BVH tree of the world triangles (modifiers applied)
+    and the area of each triangle, built once per cell and reused for all the pairs it belongs to. The cells of a packed object are
+    taken from its arrays, read once. Free it with clear() once the time point is done'''
+
+    def __init__(self):
+        self.depsgraph = bpy.context.evaluated_depsgraph_get()
+        # BVH tree and index of the 1st triangle (in the areas of all the cells) of each cell
+        self.cells = {}
+        self.areas = []
+        self.n_triangles = 0
+        # World vertices and triangles of each cell of the packed objects
+        self.packed = {}
+
+    def get(self, inCell):
+        '''Return the BVH tree of a cell (object or PackedCell) and the index of its 1st triangle'''
+        if inCell.name not in self.cells:
+            if isinstance(inCell, PackedCell):
+                if inCell.packed.name not in self.packed:
+                    self.packed[inCell.packed.name] = packed_cell_triangles(inCell.packed)
+                verts, cell_tris = self.packed[inCell.packed.name]
+                # Only the vertices of the cell, renumbered
+                used, tris = np.unique(cell_tris[inCell.cell_id], return_inverse=True)
+                verts, tris = verts[used], tris.reshape(-1, 3)
+            else:
+                verts, tris = world_mesh_arrays(inCell, self.depsgraph)
+            tree = BVHTree.FromPolygons(verts.tolist(), tris.tolist(), all_triangles=True)
+            self.cells[inCell.name] = (tree, self.n_triangles)
+            self.areas.append(triangle_areas(verts, tris))
+            self.n_triangles += len(tris)
+        return self.cells[inCell.name]
+
+    def intersection_areas(self, inPairs):
+        '''Return the scaled area of contact of each pair of cells, 0 if they do not intersect. The area is the average of the
+        areas for each cell. The overlapping triangles of all the pairs are gathered and measured at once'''
+        pair_index = []
+        triangles = []
+        for k, (obj1, obj2) in enumerate(inPairs):
+            tree1, offset1 = self.get(obj1)
+            tree2, offset2 = self.get(obj2)
+            # get intersecting pairs of triangles indices
+            inter = tree1.overlap(tree2)
+            if inter:
+                inter = np.array(inter, dtype=np.int64)
+                pair_index.append(np.full(2 * len(inter), k, dtype=np.int64))
+                triangles.append(np.concatenate((inter[:, 0] + offset1, inter[:, 1] + offset2)))
+        if not triangles:
+            return np.zeros(len(inPairs))
+        areas = contact_areas(np.concatenate(pair_index), np.concatenate(triangles), np.concatenate(self.areas), len(inPairs))
+        return areas * bpy.context.scene.unit_settings.scale_length ** 2
+
+    def clear(self):
+        self.cells.clear()
+        self.areas = []
+        self.n_triangles = 0
+        self.packed.clear()
 
 
 # ------------------------------------------------------------------------
@@ -437,6 +755,84 @@ def bmesh_copy_from_object(obj, transform=True, triangulate=True, apply_modifier
     return bm
 
 
+def mesh_from_arrays(name, verts, faces, face_sizes=None, use_smooth=None):
+    '''Create a mesh from a (N, 3) array of vertices and the faces, without going through bpy.ops.
+    Faces are either a (M, k) array or a flat array of vertex indices with the number of vertices of each face in face_sizes.
+    use_smooth optionally gives the smooth shading flag of each face.'''
+    faces = np.asarray(faces, dtype=np.int32)
+    if face_sizes is None:
+        face_sizes = np.full(len(faces), faces.shape[1] if faces.ndim == 2 else 3, dtype=np.int32)
+    face_sizes = np.asarray(face_sizes, dtype=np.int32)
+    loop_starts = np.zeros(len(face_sizes), dtype=np.int32)
+    np.cumsum(face_sizes[:-1], out=loop_starts[1:])
+    me = bpy.data.meshes.new(name)
+    me.vertices.add(len(verts))
+    me.vertices.foreach_set('co', np.ascontiguousarray(verts, dtype=np.float32).ravel())
+    me.loops.add(faces.size)
+    me.loops.foreach_set('vertex_index', faces.ravel())
+    me.polygons.add(len(face_sizes))
+    me.polygons.foreach_set('loop_start', loop_starts)
+    if bpy.app.version < (4, 0, 0):  # loop_total is derived from loop_start since Blender 4.0
+        me.polygons.foreach_set('loop_total', face_sizes)
+    if use_smooth is not None:
+        me.polygons.foreach_set('use_smooth', np.asarray(use_smooth, dtype=bool))
+    me.update(calc_edges=True)
+    me.validate()
+    return me
+
+
+def mesh_to_arrays(me):
+    '''Return the vertices (N, 3) and the triangles (M, 3) of a mesh as arrays'''
+    verts = np.empty(len(me.vertices) * 3, dtype=np.float32)
+    me.vertices.foreach_get('co', verts)
+    me.calc_loop_triangles()
+    tris = np.empty(len(me.loop_triangles) * 3, dtype=np.int32)
+    me.loop_triangles.foreach_get('vertices', tris)
+    return verts.reshape(-1, 3), tris.reshape(-1, 3)
+
+
+def world_mesh_arrays(inObj, depsgraph=None):
+    '''Return the vertices (in world coordinates) and the triangles of an object, modifiers applied'''
+    if inObj.mode == 'EDIT':
+        inObj.update_from_editmode()
+    if inObj.modifiers:
+        depsgraph = bpy.context.evaluated_depsgraph_get() if depsgraph is None else depsgraph
+        obj_eval = inObj.evaluated_get(depsgraph)
+        verts, tris = mesh_to_arrays(obj_eval.to_mesh())
+        obj_eval.to_mesh_clear()
+    else:
+        verts, tris = mesh_to_arrays(inObj.data)
+    return transform_vertices(verts, np.array(inObj.matrix_world)), tris
+
+
+def mesh_to_polygon_arrays(me):
+    '''Return the vertices (N, 3), the flat vertex indices of the faces, the number of vertices of each face and their smooth shading flag'''
+    verts = np.empty(len(me.vertices) * 3, dtype=np.float32)
+    me.vertices.foreach_get('co', verts)
+    loops = np.empty(len(me.loops), dtype=np.int32)
+    me.loops.foreach_get('vertex_index', loops)
+    face_sizes = np.empty(len(me.polygons), dtype=np.int32)
+    me.polygons.foreach_get('loop_total', face_sizes)
+    use_smooth = np.empty(len(me.polygons), dtype=bool)
+    me.polygons.foreach_get('use_smooth', use_smooth)
+    return verts.reshape(-1, 3), loops, face_sizes, use_smooth
+
+
+def mesh_dimensions(me):
+    '''Return the extent of a mesh along X, Y, Z (in local coordinates)'''
+    if len(me.vertices) == 0:
+        return np.zeros(3)
+    verts = np.empty(len(me.vertices) * 3, dtype=np.float32)
+    me.vertices.foreach_get('co', verts)
+    return np.ptp(verts.reshape(-1, 3), axis=0)
+
+
+def object_from_arrays(name, verts, faces, face_sizes=None, use_smooth=None):
+    '''Create an object (not linked to any collection) from arrays of vertices and faces'''
+    me = mesh_from_arrays(name, verts, faces, face_sizes, use_smooth)
+    return bpy.data.objects.new(name, me)
+
+
 def apply_modifiers(inObj):
     '''Applies all modifiers of the selected object.'''
     dg = bpy.context.evaluated_depsgraph_get()
@@ -449,6 +845,577 @@ def apply_modifiers(inObj):
     return inObj
 
 
+# ------------------------------------------------------------------------
+#    Packed time points
+# ------------------------------------------------------------------------
+# All the cells of a time point in a single mesh: the id of the cell of each face is stored in the face attribute 'cell_id',
+# the name of each cell (indexed by id) in the object and each cell keeps its material through the material index of its faces.
+def is_packed(inObj):
+    '''Return True if the object holds several cells packed in a single mesh'''
+    return inObj is not None and inObj.type == 'MESH' and g_cell_id_attribute in inObj.data.attributes
+
+
+def packed_object(inColl):
+    '''Return the object of a collection holding its packed cells, None if there is none'''
+    for obj in inColl.objects:
+        if is_packed(obj):
+            return obj
+    return None
+
+
+def packed_collections(inCollections):
+    '''Return the names of the collections holding packed cells'''
+    return [coll.name for coll in inCollections if any(is_packed(obj) for obj in coll.all_objects)]
+
+
+def packed_cell_names(inObj):
+    '''Return the names of the cells packed in an object, indexed by cell id ('' for the ids not used anymore)'''
+    return list(inObj.get(g_packed_names_key, []))
+
+
+def packed_to_arrays(me):
+    '''Return the arrays of a packed mesh: vertices, loops, face sizes, smooth flags, cell id and material index of each face'''
+    verts, loops, face_sizes, use_smooth = mesh_to_polygon_arrays(me)
+    cell_ids = np.empty(len(me.polygons), dtype=np.int32)
+    me.attributes[g_cell_id_attribute].data.foreach_get('value', cell_ids)
+    mat_index = np.empty(len(me.polygons), dtype=np.int32)
+    me.polygons.foreach_get('material_index', mat_index)
+    return verts, loops, face_sizes, use_smooth, cell_ids, mat_index
+
+
+def select_faces(verts, loops, face_sizes, inMask):
+    '''Keep the faces of the mask and the vertices they use. Return the vertices, loops (renumbered) and face sizes kept'''
+    loop_mask = np.repeat(inMask, face_sizes)
+    loops = loops[loop_mask]
+    used, loops = np.unique(loops, return_inverse=True)
+    return verts[used], loops.astype(np.int32), face_sizes[inMask]
+
+
+def build_packed_mesh(name, verts, loops, face_sizes, use_smooth, cell_ids, mat_index, materials):
+    '''Create a packed mesh from its arrays (see packed_to_arrays) and its list of materials'''
+    me = mesh_from_arrays(name, verts, loops, face_sizes, use_smooth)
+    me.attributes.new(name=g_cell_id_attribute, type='INT', domain='FACE')
+    me.attributes[g_cell_id_attribute].data.foreach_set('value', np.asarray(cell_ids, dtype=np.int32))
+    for material in materials:
+        me.materials.append(material)
+    me.polygons.foreach_set('material_index', np.asarray(mat_index, dtype=np.int32))
+    me.update()
+    return me
+
+
+def replace_mesh(inObj, inMesh):
+    '''Give a new mesh to an object and delete the previous one if not used anymore'''
+    old_mesh = inObj.data
+    inObj.data = inMesh
+    if old_mesh.users == 0:
+        bpy.data.meshes.remove(old_mesh)
+
+
+def pack_objects(inObjects, inPacked=None, inName='packed'):
+    '''Move the cells (objects) into a packed object, created in the collection of the first cell if inPacked is None.
+    The objects are deleted. Return the packed object.'''
+    if inPacked is not None:
+        verts, loops, face_sizes, use_smooth, cell_ids, mat_index = packed_to_arrays(inPacked.data)
+        parts = [(verts, loops, face_sizes, use_smooth, cell_ids, mat_index)]
+        materials = list(inPacked.data.materials)
+        names = packed_cell_names(inPacked)
+        to_local = np.array(inPacked.matrix_world.inverted())
+    else:
+        parts = []
+        materials = []
+        names = []
+        to_local = np.identity(4)
+    for obj in inObjects:
+        verts, loops, face_sizes, use_smooth = mesh_to_polygon_arrays(obj.data)
+        # Same coordinates as the cell in the scene
+        verts = transform_vertices(verts, to_local @ np.array(obj.matrix_world))
+        material = obj.material_slots[0].material if obj.material_slots else None
+        if material not in materials:
+            materials.append(material)
+        parts.append((verts, loops, face_sizes, use_smooth, np.full(len(face_sizes), len(names), dtype=np.int32),
+                      np.full(len(face_sizes), materials.index(material), dtype=np.int32)))
+        names.append(obj.name)
+    # Concatenate the cells, the loops are shifted by the number of vertices before them
+    offsets = np.cumsum([0] + [len(part[0]) for part in parts[:-1]])
+    verts = np.concatenate([part[0] for part in parts]).astype(np.float32)
+    loops = np.concatenate([part[1] + offset for part, offset in zip(parts, offsets)])
+    me = build_packed_mesh(inName if inPacked is None else inPacked.name, verts, loops,
+                           *[np.concatenate([part[k] for part in parts]) for k in range(2, 6)], materials)
+    if inPacked is None:
+        inPacked = bpy.data.objects.new(inName, me)
+        get_collection(inObjects[0]).objects.link(inPacked)
+    else:
+        replace_mesh(inPacked, me)
+    inPacked[g_packed_names_key] = names
+    # Delete the cells now packed
+    for obj in list(inObjects):
+        mesh = obj.data
+        bpy.data.objects.remove(obj)
+        if mesh.users == 0:
+            bpy.data.meshes.remove(mesh)
+    return inPacked
+
+
+def remove_packed_cells(inPacked, inCellIds):
+    '''Remove cells from a packed object. The object is deleted when no cell is left'''
+    verts, loops, face_sizes, use_smooth, cell_ids, mat_index = packed_to_arrays(inPacked.data)
+    keep = ~np.isin(cell_ids, list(inCellIds))
+    names = packed_cell_names(inPacked)
+    for cell_id in inCellIds:
+        names[cell_id] = ''
+    if not keep.any():
+        mesh = inPacked.data
+        bpy.data.objects.remove(inPacked)
+        bpy.data.meshes.remove(mesh)
+        return None
+    verts, loops, face_sizes = select_faces(verts, loops, face_sizes, keep)
+    me = build_packed_mesh(inPacked.data.name, verts, loops, face_sizes, use_smooth[keep], cell_ids[keep], mat_index[keep], inPacked.data.materials)
+    replace_mesh(inPacked, me)
+    inPacked[g_packed_names_key] = names
+    return inPacked
+
+
+def unpack_cells(inPacked, inCellIds=None):
+    '''Turn cells of a packed object (all if inCellIds is None) back into objects, with their origin at their center of volume,
+    in the collection of the packed object. Return the objects created'''
+    verts, loops, face_sizes, use_smooth, cell_ids, mat_index = packed_to_arrays(inPacked.data)
+    names = packed_cell_names(inPacked)
+    if inCellIds is None:
+        inCellIds = np.unique(cell_ids)
+    matrix = np.array(inPacked.matrix_world)
+    coll = get_collection(inPacked)
+    objects = []
+    for cell_id in inCellIds:
+        mask = cell_ids == cell_id
+        if not mask.any():
+            continue
+        cell_verts, cell_loops, cell_sizes = select_faces(verts, loops, face_sizes, mask)
+        cell_verts = transform_vertices(cell_verts, matrix)
+        center = volume_centroid(cell_verts, triangulate_loops(cell_loops, cell_sizes))
+        obj = object_from_arrays(names[cell_id] or f"cell_{cell_id}", cell_verts - center, cell_loops, cell_sizes, use_smooth[mask])
+        obj.location = center
+        material = inPacked.data.materials[mat_index[mask][0]] if inPacked.data.materials else None
+        if material is not None:
+            obj.data.materials.append(material)
+        coll.objects.link(obj)
+        objects.append(obj)
+    remove_packed_cells(inPacked, [int(cell_id) for cell_id in inCellIds])
+    return objects
+
+
+def packed_cell_metrics(inObj):
+    '''Return the scaled volume, area, dimensions (X, Y, Z) and center of volume of each cell of a packed object, computed
+    at once on the arrays of the mesh: {name: (volume, area, dimensions, center)}'''
+    cached = g_metric_cache.get(inObj, 'packed_metrics')
+    if cached is not None:
+        return cached
+    me = inObj.data
+    verts, tris = mesh_to_arrays(me)
+    verts = transform_vertices(verts, np.array(inObj.matrix_world))
+    tri_faces = np.empty(len(me.loop_triangles), dtype=np.int32)
+    me.loop_triangles.foreach_get('polygon_index', tri_faces)
+    cell_ids = np.empty(len(me.polygons), dtype=np.int32)
+    me.attributes[g_cell_id_attribute].data.foreach_get('value', cell_ids)
+    tri_cells = cell_ids[tri_faces]
+    names = packed_cell_names(inObj)
+    n_cells = len(names)
+    volumes, areas = volumes_and_areas(verts, tris, tri_cells, n_cells)
+    # Centroids of the tetrahedra formed by each triangle and the origin, weighted by their signed volumes
+    v0, v1, v2 = verts[tris[:, 0]], verts[tris[:, 1]], verts[tris[:, 2]]
+    tetra_volumes = np.einsum('ij,ij->i', v0, np.cross(v1, v2)) / 6
+    centers = np.stack([np.bincount(tri_cells, weights=tetra_volumes * (v0 + v1 + v2)[:, k] / 4, minlength=n_cells) for k in range(3)], axis=1)
+    centers = centers / np.where(volumes == 0, 1, volumes)[:, None]
+    # Extent of each cell: bounds of the vertices of its triangles
+    lows = np.full((n_cells, 3), np.inf)
+    highs = np.full((n_cells, 3), -np.inf)
+    for corner in (v0, v1, v2):
+        np.minimum.at(lows, tri_cells, corner)
+        np.maximum.at(highs, tri_cells, corner)
+    scale = bpy.context.scene.unit_settings.scale_length
+    metrics = {}
+    for cell_id in np.unique(tri_cells):
+        metrics[names[cell_id]] = (abs(volumes[cell_id]) * scale ** 3, areas[cell_id] * scale ** 2,
+                                   (highs[cell_id] - lows[cell_id]) * scale, centers[cell_id] * scale)
+    g_metric_cache.put(inObj, 'packed_metrics', metrics)
+    return metrics
+
+
+def packed_cell_places(inObj):
+    '''Return the center of volume (world coordinates, NOT scaled) and the material of each cell of a packed object:
+    {name: (center, material)}'''
+    me = inObj.data
+    cell_ids = np.empty(len(me.polygons), dtype=np.int32)
+    me.attributes[g_cell_id_attribute].data.foreach_get('value', cell_ids)
+    mat_index = np.empty(len(me.polygons), dtype=np.int32)
+    me.polygons.foreach_get('material_index', mat_index)
+    # Material of the 1st face of each cell
+    ids, first_faces = np.unique(cell_ids, return_index=True)
+    materials = {int(cell_id): me.materials[mat_index[face]] if me.materials else None for cell_id, face in zip(ids, first_faces)}
+    metrics = packed_cell_metrics(inObj)
+    scale = bpy.context.scene.unit_settings.scale_length
+    return {name: (Vector(metrics[name][3] / scale), materials[cell_id])
+            for cell_id, name in enumerate(packed_cell_names(inObj)) if name and cell_id in materials}
+
+
+# ------------------------------------------------------------------------
+#    Metric cache
+# ------------------------------------------------------------------------
+class MetricCache:
+    '''LRU cache of the measurements of the objects, keyed by the name of the object. Each entry holds a geometry fingerprint
+    and the metrics computed for it ({metric: value}): an entry whose fingerprint no longer matches the object is stale and dropped'''
+
+    def __init__(self, inMaxSize=g_metric_cache_size):
+        self.max_size = inMaxSize
+        self.entries = OrderedDict()
+        # Update counter of each object, bumped by the depsgraph handler when its geometry or transform changes
+        self.versions = {}
+        self.hits = 0
+        self.misses = 0
+
+    def fingerprint(self, inObj):
+        '''Cheap signature of the geometry of an object: mesh data pointer, vertex count, bounding box, world matrix,
+        unit scale and update counter'''
+        me = inObj.data
+        return (me.as_pointer(), len(me.vertices), tuple(c for corner in inObj.bound_box for c in corner),
+                tuple(c for row in inObj.matrix_world for c in row), bpy.context.scene.unit_settings.scale_length,
+                self.versions.get(inObj.name_full, 0))
+
+    def get(self, inObj, inMetric, inFingerprint=None):
+        '''Return the cached value of a metric for an object or None if missing or stale'''
+        key = inObj.name_full
+        entry = self.entries.get(key)
+        if entry is not None:
+            fingerprint = inFingerprint if inFingerprint is not None else self.fingerprint(inObj)
+            if entry[0] != fingerprint:
+                # The geometry changed: none of the metrics is valid anymore
+                del self.entries[key]
+            elif inMetric in entry[1]:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1][inMetric]
+        self.misses += 1
+        return None
+
+    def peek(self, inObj, inMetric, inFingerprint=None):
+        '''Return the cached value of a metric for an object or None, without updating the statistics nor the LRU order'''
+        entry = self.entries.get(inObj.name_full)
+        if entry is None or inMetric not in entry[1]:
+            return None
+        fingerprint = inFingerprint if inFingerprint is not None else self.fingerprint(inObj)
+        return entry[1][inMetric] if entry[0] == fingerprint else None
+
+    def put(self, inObj, inMetric, inValue, inFingerprint=None):
+        '''Store the value of a metric for an object, evicting the least recently used objects beyond the maximum size'''
+        key = inObj.name_full
+        fingerprint = inFingerprint if inFingerprint is not None else self.fingerprint(inObj)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != fingerprint:
+            entry = (fingerprint, {})
+            self.entries[key] = entry
+        entry[1][inMetric] = inValue
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            evicted, _ = self.entries.popitem(last=False)
+            self.versions.pop(evicted, None)
+
+    def bump(self, inName):
+        '''Mark the metrics of an object as stale'''
+        if inName in self.entries:
+            self.versions[inName] = self.versions.get(inName, 0) + 1
+
+    def invalidate(self, inObj=None):
+        '''Drop the entry of an object, or all the entries if no object is given'''
+        if inObj is None:
+            self.entries.clear()
+            self.versions.clear()
+        else:
+            self.entries.pop(inObj.name_full, None)
+            self.versions.pop(inObj.name_full, None)
+
+    def stats(self):
+        '''Return the number of entries, hits, misses and the hit rate'''
+        lookups = self.hits + self.misses
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+g_metric_cache = MetricCache()
+
+
+@persistent
+def metric_cache_depsgraph_update(scene, depsgraph):
+    '''Bump the update counter of the cached objects whose geometry or transform changed'''
+    for update in depsgraph.updates:
+        if isinstance(update.id, bpy.types.Object) and (update.is_updated_geometry or update.is_updated_transform):
+            g_metric_cache.bump(update.id.original.name_full)
+
+
+def metrics_digest(inFingerprint):
+    '''Digest of the part of a fingerprint that survives saving and reloading the file (no data pointer nor update counter)'''
+    return hashlib.blake2b(repr(inFingerprint[1:5]).encode(), digest_size=8).hexdigest()
+
+
+def geometry_digest(inObj):
+    '''Digest of the geometry of an object (vertex count, bounding box, world matrix and unit scale), stable across sessions'''
+    return metrics_digest(g_metric_cache.fingerprint(inObj))
+
+
+def read_stored_metrics(inColl):
+    '''Return the metrics stored in a time point: {object name: (digest, {cell name: (volume, area, dimensions, center)})}.
+    The cell name is '' for the objects holding a single cell'''
+    store = inColl.get(g_metrics_key)
+    if store is None:
+        return {}
+    values = np.array(store['values'], dtype=np.float64).reshape(-1, g_metric_fields)
+    stored = {}
+    for obj_name, cell_name, digest, row in zip(store['objects'], store['cells'], store['digests'], values):
+        stored.setdefault(obj_name, (digest, {}))[1][cell_name] = (row[0], row[1], tuple(row[2:5]), tuple(row[5:8]))
+    return stored
+
+
+def store_metrics(inColl):
+    '''Write in a time point the metrics of its cells found in the cache, or still valid in the previous store'''
+    stored = read_stored_metrics(inColl)
+    scale = bpy.context.scene.unit_settings.scale_length
+    objects, cells, digests, values = [], [], [], []
+    for obj in inColl.objects:
+        if obj.type != 'MESH':
+            continue
+        fingerprint = g_metric_cache.fingerprint(obj)
+        digest = metrics_digest(fingerprint)
+        if is_packed(obj):
+            metrics = g_metric_cache.peek(obj, 'packed_metrics', fingerprint)
+        else:
+            vol_area = g_metric_cache.peek(obj, 'vol_area', fingerprint)
+            metrics = None if vol_area is None else {'': (*vol_area, scaled_dimensions(obj), get_global_coordinates(obj) * scale)}
+        if metrics is None:
+            previous = stored.get(obj.name)
+            if previous is None or previous[0] != digest:
+                continue
+            metrics = previous[1]
+        for cell_name, (volume, area, dims, center) in metrics.items():
+            objects.append(obj.name)
+            cells.append(cell_name)
+            digests.append(digest)
+            values.extend(float(v) for v in (volume, area, *dims, *center))
+    if objects:
+        inColl[g_metrics_key] = {'objects': objects, 'cells': cells, 'digests': digests, 'values': values}
+    elif g_metrics_key in inColl:
+        del inColl[g_metrics_key]
+
+
+def warm_metric_cache():
+    '''Fill the cache with the metrics stored in the time points whose objects did not change since they were stored'''
+    for coll in bpy.data.collections:
+        for obj_name, (digest, metrics) in read_stored_metrics(coll).items():
+            obj = coll.objects.get(obj_name)
+            if obj is None or obj.type != 'MESH':
+                continue
+            fingerprint = g_metric_cache.fingerprint(obj)
+            if metrics_digest(fingerprint) != digest:
+                continue
+            if is_packed(obj):
+                g_metric_cache.put(obj, 'packed_metrics', metrics, fingerprint)
+            elif '' in metrics:
+                g_metric_cache.put(obj, 'vol_area', metrics[''][:2], fingerprint)
+
+
+@persistent
+def metric_cache_load_post(dummy):
+    '''A new file is loaded: the names of the cached objects refer to objects of the previous file. Warm the cache from the
+    metrics stored in the file'''
+    g_metric_cache.invalidate()
+    warm_metric_cache()
+
+
+@persistent
+def metric_cache_undo_post(dummy):
+    '''Undo and redo restore the geometry without reporting it to the depsgraph handler: drop the cached metrics and warm the
+    cache again from the metrics stored in the restored file'''
+    g_metric_cache.invalidate()
+    warm_metric_cache()
+
+
+@persistent
+def metric_cache_save_pre(dummy):
+    '''Store the cached metrics in the time points holding cached objects'''
+    for coll in bpy.data.collections:
+        if g_metrics_key in coll or any(obj.name_full in g_metric_cache.entries for obj in coll.objects):
+            store_metrics(coll)
+
+
+# ------------------------------------------------------------------------
+#    Cell registry
+# ------------------------------------------------------------------------
+def cell_label(inName):
+    '''Return the label of a cell parsed from its name ('label<n>' or the last number of the name), -1 if none'''
+    match = re.search(r'label_?(\d+)', inName) or re.search(r'(\d+)(?:\.\d{3})?$', inName)
+    return int(match.group(1)) if match else -1
+
+
+class CellRegistry:
+    '''Columnar registry of the cells (mesh objects) of the scene: one row per cell in a NumPy structured array, with the time
+    point (1st level collection), collection, label, center & bounding box (world coordinates, NOT scaled), scaled volume & area
+    (NaN until measured) and a dirty flag set when the geometry or transform of the cell changed.
+    Packed time points are not registered: their cells are not objects (see packed_cell_metrics())'''
+    dtype = np.dtype([('name', 'U64'), ('time_point', 'U64'), ('collection', 'U64'), ('label', np.int64),
+                      ('center', np.float64, 3), ('bbox_min', np.float64, 3), ('bbox_max', np.float64, 3),
+                      ('volume', np.float64), ('area', np.float64), ('dirty', np.bool_)])
+
+    def __init__(self):
+        self.cells = np.zeros(0, dtype=self.dtype)
+        # Row of each cell, by name
+        self.index = {}
+        # Set when cells were added, removed, renamed or moved between collections: the registry must be rebuilt
+        self.stale = True
+        self.scene = None
+        self.n_objects = -1
+
+    def build(self):
+        '''Rebuild the registry from the objects of the scene'''
+        scene = bpy.context.scene
+        time_points = {}
+        for coll in scene.collection.children:
+            for obj in coll.all_objects:
+                time_points.setdefault(obj.name, coll.name)
+        objects = [obj for obj in scene.objects if obj.type == 'MESH' and not is_packed(obj)]
+        cells = np.zeros(len(objects), dtype=self.dtype)
+        cells['name'] = [obj.name for obj in objects]
+        cells['time_point'] = [time_points.get(obj.name, '') for obj in objects]
+        cells['collection'] = [get_collection(obj).name for obj in objects]
+        cells['label'] = [cell_label(obj.name) for obj in objects]
+        cells['dirty'] = True
+        self.cells = cells
+        self.index = {obj.name: k for k, obj in enumerate(objects)}
+        self.stale = False
+        self.scene = scene.name
+        self.n_objects = len(scene.objects)
+        self.refresh()
+
+    def refresh(self):
+        '''Update the center, bounding box, volume and area of the dirty cells'''
+        rows = np.flatnonzero(self.cells['dirty'])
+        if len(rows) == 0:
+            return
+        objects = bpy.data.objects
+        for k in rows:
+            obj = objects[self.cells['name'][k]]
+            corners = transform_vertices(np.array(obj.bound_box), np.array(obj.matrix_world))
+            self.cells['bbox_min'][k] = corners.min(axis=0)
+            self.cells['bbox_max'][k] = corners.max(axis=0)
+            self.cells['center'][k] = get_global_coordinates(obj) if len(obj.data.vertices) else obj.matrix_world.translation
+            vol_area = g_metric_cache.peek(obj, 'vol_area')
+            self.cells['volume'][k], self.cells['area'][k] = vol_area if vol_area is not None else (np.nan, np.nan)
+        self.cells['dirty'][rows] = False
+
+    def mark_dirty(self, inName):
+        '''Flag the row of a cell for refresh, or the whole registry for rebuild if the cell is unknown'''
+        k = self.index.get(inName)
+        if k is None:
+            self.stale = True
+        else:
+            self.cells['dirty'][k] = True
+
+    def row(self, inName):
+        '''Return the row of a cell given by name, rebuilding the registry if it is unknown; None if it is not a cell'''
+        if inName not in self.index:
+            self.build()
+        return self.index.get(inName)
+
+    def rows(self, inNames):
+        '''Return the rows of cells given by name, rebuilding the registry if some are unknown. Names that are not cells are ignored'''
+        inNames = list(inNames)
+        if any(name not in self.index for name in inNames):
+            self.build()
+        return np.array([self.index[name] for name in inNames if name in self.index], dtype=np.int64)
+
+    def time_point_rows(self, inTimePoint):
+        '''Return the rows of the cells of a time point'''
+        return np.flatnonzero(self.cells['time_point'] == inTimePoint)
+
+    def measure(self, inRows=None):
+        '''Update the volume & area of the cells (all or the rows given). They come from the metric cache, which checks the
+        geometry of each cell, so that edits made while the handlers did not run (undo, scripts...) are measured again'''
+        rows = np.arange(len(self.cells)) if inRows is None else np.asarray(inRows, dtype=np.int64)
+        if len(rows) == 0:
+            return
+        objects = [bpy.data.objects[name] for name in self.cells['name'][rows]]
+        vol_area = np.array(volumes_and_areas_from_objects(objects), dtype=np.float64).reshape(-1, 2)
+        self.cells['volume'][rows] = vol_area[:, 0]
+        self.cells['area'][rows] = vol_area[:, 1]
+
+    def nearest(self, inTimePoint, inPosition):
+        '''Return the name of the cell of a time point closest to a position (NOT scaled) and its scaled distance, (None, inf)
+        if the time point has no cell'''
+        rows = self.time_point_rows(inTimePoint)
+        if len(rows) == 0:
+            return None, np.inf
+        distances = np.linalg.norm(self.cells['center'][rows] - np.asarray(inPosition, dtype=np.float64), axis=1)
+        k = np.argmin(distances)
+        return str(self.cells['name'][rows[k]]), distances[k] * bpy.context.scene.unit_settings.scale_length
+
+
+g_cell_registry = CellRegistry()
+
+
+def cell_registry():
+    '''Return the registry of the cells of the scene, rebuilt if cells were added, removed, renamed or moved and with the
+    dirty rows refreshed'''
+    scene = bpy.context.scene
+    if g_cell_registry.stale or g_cell_registry.scene != scene.name or g_cell_registry.n_objects != len(scene.objects):
+        g_cell_registry.build()
+    else:
+        g_cell_registry.refresh()
+    return g_cell_registry
+
+
+@persistent
+def cell_registry_depsgraph_update(scene, depsgraph):
+    '''Keep the registry in sync: flag the cells whose geometry or transform changed, or the registry if the collections changed'''
+    for update in depsgraph.updates:
+        if isinstance(update.id, bpy.types.Collection):
+            g_cell_registry.stale = True
+        elif isinstance(update.id, bpy.types.Object) and update.id.type == 'MESH' and not is_packed(update.id.original):
+            name = update.id.original.name
+            if name not in g_cell_registry.index:
+                g_cell_registry.stale = True
+            elif update.is_updated_geometry or update.is_updated_transform:
+                g_cell_registry.mark_dirty(name)
+
+
+@persistent
+def cell_registry_load_post(dummy):
+    g_cell_registry.stale = True
+
+
+@persistent
+def cell_registry_undo_post(dummy):
+    '''Undo and redo rebuild the data of the file: the objects held by the registry are no longer valid'''
+    g_cell_registry.stale = True
+
+
+# Handlers keeping the caches in sync with the file
+g_handlers = (('depsgraph_update_post', collection_index_depsgraph_update), ('load_post', collection_index_load_post),
+              ('undo_post', collection_index_undo_post), ('redo_post', collection_index_undo_post),
+              ('depsgraph_update_post', metric_cache_depsgraph_update), ('load_post', metric_cache_load_post),
+              ('undo_post', metric_cache_undo_post), ('redo_post', metric_cache_undo_post),
+              ('save_pre', metric_cache_save_pre),
+              ('depsgraph_update_post', cell_registry_depsgraph_update), ('load_post', cell_registry_load_post),
+              ('undo_post', cell_registry_undo_post), ('redo_post', cell_registry_undo_post))
+
+
+def register_handlers():
+    for handler_type, handler in g_handlers:
+        getattr(bpy.app.handlers, handler_type).append(handler)
+
+
+def unregister_handlers():
+    for handler_type, handler in g_handlers:
+        handlers = getattr(bpy.app.handlers, handler_type)
+        if handler in handlers:
+            handlers.remove(handler)
+
+
 # ------------------------------------------------------------------------
 #    GUI - 2D display
 # ------------------------------------------------------------------------
@@ -26,6 +26,7 @@ from .Quantify import (MORPHOBLEND_PT_Quantify, register_quantify,
 from .Analyze import MORPHOBLEND_PT_Analyze, register_analyze, unregister_analyze
 from .Render import MORPHOBLEND_PT_Render, register_render, unregister_render
 from .Export import MORPHOBLEND_PT_Export, register_export, unregister_export
+from .Utilities import register_handlers, unregister_handlers
 from . import addon_updater_ops
 from .Update import MORPHOBLEND_PT_Updater, MORPHOBLEND_PF_Updater
 
@@ -141,9 +142,11 @@ def register():
     register_quantify()
     register_render()
     register_export()
+    register_handlers()
 
 
 def unregister():
+    unregister_handlers()
     unregister_export()
     unregister_render()
     unregister_quantify()
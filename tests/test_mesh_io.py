@@ -0,0 +1,80 @@
+import importlib.util
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+# Mesh_io does not import bpy: load it without the add-on (whose __init__ needs Blender)
+g_mesh_io_path = Path(__file__).resolve().parent.parent / 'morphoblend' / 'Mesh_io.py'
+spec = importlib.util.spec_from_file_location('Mesh_io', g_mesh_io_path)
+Mesh_io = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(Mesh_io)
+
+g_obj_cell = '''# Y up tetrahedron
+v 0.0 0.0 0.0
+v 1.0 0.0 0.0
+v 0.0 2.0 0.0
+v 0.0 0.0 3.0
+vn 0.0 0.0 1.0
+f 1//1 3//1 2//1
+f 1 2 4
+f 1 4 3
+f 2 3 4
+'''
+
+
+@pytest.fixture
+def obj_path(tmp_path):
+    path = tmp_path / 'cell.obj'
+    path.write_text(g_obj_cell)
+    return path
+
+
+def test_read_obj_converts_y_up_to_z_up(obj_path):
+    verts, faces = Mesh_io.read_obj(obj_path)
+    # (x, y, z) -> (x, -z, y)
+    expected = np.array([[0, 0, 0], [1, 0, 0], [0, 0, 2], [0, -3, 0]], dtype=np.float32)
+    np.testing.assert_allclose(verts, expected)
+    np.testing.assert_array_equal(faces, [[0, 2, 1], [0, 1, 3], [0, 3, 2], [1, 2, 3]])
+
+
+def test_read_obj_matches_blender_importer(obj_path):
+    '''The native reader and the OBJ importer of Blender (legacy reader) give the same vertices'''
+    bpy = pytest.importorskip('bpy')
+    bpy.ops.wm.read_factory_settings(use_empty=True)
+    bpy.ops.import_scene.obj(filepath=obj_path.as_posix())
+    obj = bpy.context.selected_objects[0]
+    legacy = np.array([obj.matrix_world @ v.co for v in obj.data.vertices], dtype=np.float32)
+    verts, _ = Mesh_io.read_obj(obj_path)
+    # The importer may reorder the vertices: compare them sorted
+    np.testing.assert_allclose(np.unique(verts, axis=0), np.unique(legacy, axis=0), atol=1e-6)
+
+
+def test_cache_key_follows_the_content(tmp_path, obj_path):
+    '''A copy of a file, elsewhere, shares the cache entry of the original; a changed file does not'''
+    copy_path = tmp_path / 'elsewhere' / 'copy.obj'
+    copy_path.parent.mkdir()
+    copy_path.write_bytes(obj_path.read_bytes())
+    entry = Mesh_io.cached_mesh_path(tmp_path, Mesh_io.file_digest(obj_path), 'settings')
+    assert Mesh_io.cached_mesh_path(tmp_path, Mesh_io.file_digest(copy_path), 'settings') == entry
+    assert Mesh_io.cached_mesh_path(tmp_path, Mesh_io.file_digest(copy_path), 'other settings') != entry
+    copy_path.write_text(g_obj_cell + 'v 1.0 1.0 1.0\n')
+    assert Mesh_io.cached_mesh_path(tmp_path, Mesh_io.file_digest(copy_path), 'settings') != entry
+
+
+def test_digest_index_is_persisted(tmp_path, obj_path):
+    cache_dir = tmp_path / 'cache'
+    index = Mesh_io.DigestIndex(cache_dir)
+    assert index.get(obj_path) is None
+    digest = index.digest(obj_path)
+    index.save()
+    assert Mesh_io.DigestIndex(cache_dir).get(obj_path) == digest
+
+
+def test_worker_skips_the_files_in_the_cache(tmp_path, obj_path):
+    cache_dir = tmp_path / 'cache'
+    digest = Mesh_io.file_digest(obj_path)
+    Mesh_io.save_cached_mesh(Mesh_io.cached_mesh_path(cache_dir, digest, 'settings'), verts=np.zeros((0, 3)))
+    key, verts_desc, faces_desc, center, _ = Mesh_io.parse_to_shared_memory(obj_path, np.eye(3), cache_dir, 'settings')
+    assert key == (obj_path, digest)
+    assert verts_desc is None and faces_desc is None and center is None
@@ -1,7 +1,11 @@
 import argparse
+import json
 import logging
 import re
 import os
+import subprocess
+import sys
+import threading
 from math import radians
 from pathlib import Path
 from random import randrange
@@ -11,11 +15,11 @@ import bpy
 #import numpy as np
 #from mathutils import Matrix, Vector
 
-from morphoblend.Utilities import number_of_file_to_import
-from morphoblend.Import import (initialise, import_process_assign)
+from morphoblend.Utilities import scan_mesh_files
+from morphoblend.Import import (g_allowed_extension, initialise, prescan_mesh_files, import_process_assign, iter_mesh_files, load_import_manifest, save_import_manifest,
+                                files_to_import, record_import, pack_collection, save_digest_index, g_import_stats, import_report_summary, write_import_report)
 
 g_import_coll_name = 'Imported' #TODO  Is this still needed?
-g_allowed_extension = ('.obj', '.OBJ', '.ply', '.PLY')
 g_output_basename = 'Output'
 
 
@@ -29,6 +33,22 @@ def args_parser():
     parser.add_argument('--path', type=str, help='Path to the folder containing the PLY files to import.', required=True)
     parser.add_argument('--voxel', nargs='+', type=float, help='Voxel dimensions in µm (x/y/z)', required=True)
     parser.add_argument('--rotation', nargs='+', type=int, help='Rotation to apply to each axis in deg (x/y/z)', required=True)
+    # Optional arguments
+    parser.add_argument('--legacy-reader', action='store_true', help='Read the files with the Blender importers instead of the built-in reader.')
+    parser.add_argument('--resume', action='store_true', help='Continue an interrupted or previous import: files already in the output file are skipped, changed ones are replaced.')
+    parser.add_argument('--checkpoint', type=int, help='Save the output file every N imported files (0: only at the end).', required=False, default=500)
+    parser.add_argument('--workers', type=int, help='Number of processes reading the files in parallel.', required=False, default=max(1, (os.cpu_count() or 1) - 1))
+    parser.add_argument('--cache', type=str, help='Folder of the cache of processed meshes: re-imports with the same settings skip the smoothing.', required=False, default='')
+    parser.add_argument('--min-faces', type=int, help='Skip the files with fewer faces (debris), read from the PLY header.', required=False, default=0)
+    parser.add_argument('--face-budget', type=int, help='Number of triangles of each cell after smoothing (instead of fixed settings).', required=False, default=0)
+    parser.add_argument('--edge-length', type=float, help='Length of the edges of the triangles after smoothing in µm (instead of fixed settings).', required=False, default=0)
+    parser.add_argument('--pack', action='store_true', help='Store all the cells of a time point in a single mesh.')
+    parser.add_argument('--stream', action='store_true', help='Import one time point at a time, each saved to its own file and freed before the next one, then linked into the output file.')
+    parser.add_argument('--append', action='store_true', help='With --stream: append the time points into the output file instead of linking them.')
+    parser.add_argument('--shards', type=int, help='Split the time point subfolders across N background Blender processes and merge their results.', required=False, default=1)
+    # Internal arguments, passed by the driver to each shard
+    parser.add_argument('--folders', nargs='+', type=str, help=argparse.SUPPRESS, required=False, default=None)
+    parser.add_argument('--output', type=str, help=argparse.SUPPRESS, required=False, default=g_output_basename)
     parsed_script_args, _ = parser.parse_known_args(script_args)
 
     return parsed_script_args
@@ -37,48 +57,268 @@ def args_parser():
 def main():
     # Get the scripts arguments
     args = args_parser()
+    outfile_path = Path(bpy.path.abspath(args.path), args.output).with_suffix('.blend')
+    resume = args.resume and outfile_path.exists()
     # Configure logging
-    log_path = Path(bpy.path.abspath(args.path), g_output_basename).with_suffix('.log')
-    logging.basicConfig(level=logging.INFO, filename=log_path, filemode='w', format='%(asctime)s - %(message)s')
-    # Remove everything from the project and initialise scene
-    cleanup()
-    initialise('Qual_bright', args.voxel, args.rotation)
-    process_input(args.path)
+    if args.folders is not None:
+        # Shard: the driver collects the output and writes the log
+        logging.basicConfig(level=logging.INFO, stream=sys.stdout, format='%(message)s')
+    else:
+        log_path = Path(bpy.path.abspath(args.path), g_output_basename).with_suffix('.log')
+        logging.basicConfig(level=logging.INFO, filename=log_path, filemode='a' if resume else 'w', format='%(asctime)s - %(message)s')
+    if args.stream:
+        if args.shards > 1:
+            logging.warning('--shards is not supported with --stream: importing in a single process.')
+        run_stream(args, outfile_path)
+        return
+    if args.shards > 1 and not resume:
+        run_shards(args)
+        return
+    if args.shards > 1:
+        # The files of the shards that succeeded are in the output file: the ones left are imported here
+        logging.info('Resuming in a single process: --shards is ignored.')
+    if resume:
+        # Start from the previous output (or last checkpoint)
+        bpy.ops.wm.open_mainfile(filepath=outfile_path.as_posix())
+        logging.info('Resuming from %s', outfile_path)
+    else:
+        # Remove everything from the project
+        cleanup()
+    # Initialise scene
+    initialise('Qual_bright', args.voxel, args.rotation, in_native_reader=not args.legacy_reader, in_cache_dir=args.cache,
+               **smoothing_settings(args))
+    process_input(args.path, args.workers, outfile_path, args.checkpoint, args.folders, args.min_faces, args.pack)
     # Save the file
-    outfile_path = Path(bpy.path.abspath(args.path), g_output_basename).with_suffix('.blend')
     bpy.ops.wm.save_as_mainfile(filepath=outfile_path.as_posix())
+    report_timings(outfile_path)
+    if args.folders is not None:
+        # Hand over the list of imported files to the driver
+        with open(outfile_path.with_suffix('.json'), 'w', encoding='utf-8') as f:
+            json.dump(load_import_manifest(bpy.context.scene), f)
     logging.info('Finished!')
 
-def process_input(folder_path):
-     # Get total number of files to process
-    total_n_files_to_import = number_of_file_to_import(bpy.path.abspath(folder_path), g_allowed_extension)
-    progress = 0
+
+def smoothing_settings(args):
+    '''Resolution of the smoothed cells: fixed settings unless a face budget or an edge length is given'''
+    if args.face_budget > 0:
+        return {'in_smoothing_mode': 'FACES', 'in_target_faces': args.face_budget}
+    if args.edge_length > 0:
+        return {'in_smoothing_mode': 'EDGE', 'in_target_edge': args.edge_length}
+    return {'in_smoothing_mode': 'FIXED'}
+
+
+def run_stream(args, outfile_path):
+    '''Import one time point (subfolder) at a time: each one is saved to its own file and removed from memory before the next one,
+    then all are linked (or appended) into the output file. The peak memory is the one of the largest time point.'''
+    folder_path = Path(bpy.path.abspath(args.path))
+    library_dir = outfile_path.with_name(f"{outfile_path.stem}_timepoints")
+    library_dir.mkdir(exist_ok=True)
+    # Scan the folder once, group the files per subfolder
+    files_per_subfolder = {}
+    for mesh_file in scan_mesh_files(folder_path, g_allowed_extension):
+        files_per_subfolder.setdefault(mesh_file[0], []).append(mesh_file)
+    logging.info('Starting. Will import %s subfolders one at a time', len(files_per_subfolder))
+    cleanup()
+    settings = dict(in_native_reader=not args.legacy_reader, in_cache_dir=args.cache, **smoothing_settings(args))
+    initialise('Qual_bright', args.voxel, args.rotation, **settings)
+    libraries = []
+    manifest = {}
+    stats = []
+    for subfolder, mesh_files in files_per_subfolder.items():
+        library_path = Path(library_dir, subfolder.replace('/', '_')).with_suffix('.blend')
+        # Files imported and their timings, written once the time point is saved: a time point is complete when both exist
+        record_path = library_path.with_suffix('.json')
+        libraries.append(library_path)
+        if args.resume and library_path.exists() and record_path.exists():
+            with open(record_path, 'r', encoding='utf-8') as f:
+                record = json.load(f)
+            manifest.update(record['manifest'])
+            stats.extend(record['files'])
+            logging.info('Subfolder %s already imported in %s', subfolder, library_path)
+            continue
+        process_input(folder_path.as_posix(), args.workers, min_faces=args.min_faces, pack=args.pack, mesh_files=mesh_files)
+        bpy.ops.wm.save_as_mainfile(filepath=library_path.as_posix(), copy=True)
+        with open(record_path, 'w', encoding='utf-8') as f:
+            json.dump({'manifest': load_import_manifest(bpy.context.scene), 'files': g_import_stats}, f)
+        logging.info('Subfolder %s saved to %s', subfolder, library_path)
+        manifest.update(load_import_manifest(bpy.context.scene))
+        stats.extend(g_import_stats)
+        # Free the memory before the next time point: cells, then their meshes and materials left without users
+        cleanup()
+        bpy.data.orphans_purge(do_local_ids=True, do_linked_ids=True, do_recursive=True)
+        # The materials palette was purged too
+        initialise('Qual_bright', args.voxel, args.rotation, **settings)
+    # Master file: all the time points
+    merge_data([library.as_posix() for library in libraries], link=not args.append)
+    save_import_manifest(bpy.context.scene, manifest)
+    bpy.ops.wm.save_as_mainfile(filepath=outfile_path.as_posix())
+    g_import_stats[:] = stats
+    report_timings(outfile_path)
+    logging.info('Finished!')
+
+
+def run_shards(args):
+    '''Driver: split the subfolders across several background Blender processes, then merge their output files'''
+    folder_path = Path(bpy.path.abspath(args.path))
+    # Group the files per subfolder (relative to the root folder)
+    n_files_per_folder = {}
+    n_bytes_per_folder = {}
+    for subfolder, _, size, _ in scan_mesh_files(folder_path, g_allowed_extension):
+        n_files_per_folder[subfolder] = n_files_per_folder.get(subfolder, 0) + 1
+        n_bytes_per_folder[subfolder] = n_bytes_per_folder.get(subfolder, 0) + size
+    # Balance the amount of data: largest subfolders first, each to the least loaded shard
+    n_shards = min(args.shards, len(n_files_per_folder))
+    shards = [[] for _ in range(n_shards)]
+    load = [0] * n_shards
+    n_files = [0] * n_shards
+    for subfolder, n_bytes in sorted(n_bytes_per_folder.items(), key=lambda i: -i[1]):
+        k = load.index(min(load))
+        shards[k].append(subfolder)
+        load[k] += n_bytes
+        n_files[k] += n_files_per_folder[subfolder]
+    logging.info('Starting. Will import a total of %s files in %s subfolders with %s processes', sum(n_files), len(n_files_per_folder), n_shards)
+    # Launch one background Blender per shard
+    script_path = Path(__file__).resolve().as_posix()
+    n_workers = max(1, args.workers // max(n_shards, 1))
+    processes = []
+    parts = []
+    for k, subfolders in enumerate(shards):
+        part_name = f"{g_output_basename}_part{k:02}"
+        parts.append(Path(folder_path, part_name).with_suffix('.blend'))
+        cmd = [bpy.app.binary_path, '-b', '--python', script_path, '--',
+               '--path', folder_path.as_posix(),
+               '--voxel', *[str(v) for v in args.voxel],
+               '--rotation', *[str(r) for r in args.rotation],
+               '--workers', str(n_workers), '--checkpoint', '0', '--min-faces', str(args.min_faces),
+               '--output', part_name, '--folders', *subfolders]
+        if args.legacy_reader:
+            cmd.append('--legacy-reader')
+        if args.cache:
+            cmd.extend(['--cache', args.cache])
+        if args.pack:
+            cmd.append('--pack')
+        if args.face_budget > 0:
+            cmd.extend(['--face-budget', str(args.face_budget)])
+        if args.edge_length > 0:
+            cmd.extend(['--edge-length', str(args.edge_length)])
+        logging.info('Shard %s: %s files (%.0f MB) in %s', k, n_files[k], load[k] / 1e6, ', '.join(subfolders))
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1)
+        # Relay the output of each shard into the log
+        relay = threading.Thread(target=relay_output, args=(process, k), daemon=True)
+        relay.start()
+        processes.append((process, relay))
+    failed = []
+    for k, (process, relay) in enumerate(processes):
+        process.wait()
+        relay.join()
+        if process.returncode != 0 or not parts[k].exists():
+            failed.append(k)
+            logging.error('Shard %s failed (return code %s)', k, process.returncode)
+    # Merge all the parts in the final file
+    cleanup()
+    initialise('Qual_bright', args.voxel, args.rotation, in_native_reader=not args.legacy_reader)
+    done = [part for k, part in enumerate(parts) if k not in failed]
+    manifest = {}
+    for part in done:
+        manifest_path = part.with_suffix('.json')
+        if manifest_path.exists():
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest.update(json.load(f))
+            os.remove(manifest_path)
+    merge_data([part.as_posix() for part in done])
+    save_import_manifest(bpy.context.scene, manifest)
+    outfile_path = Path(folder_path, g_output_basename).with_suffix('.blend')
+    bpy.ops.wm.save_as_mainfile(filepath=outfile_path.as_posix())
+    # Gather the timings of all shards
+    for part in done:
+        timings_path = part.with_name(f"{part.stem}_timings")
+        if timings_path.with_suffix('.json').exists():
+            with open(timings_path.with_suffix('.json'), 'r', encoding='utf-8') as f:
+                g_import_stats.extend(json.load(f)['files'])
+            os.remove(timings_path.with_suffix('.json'))
+            os.remove(timings_path.with_suffix('.csv'))
+    report_timings(outfile_path)
+    if failed:
+        logging.error('Finished with errors: shards %s failed. Re-run with --resume to import their files into %s (in a single process).', failed, outfile_path)
+    else:
+        logging.info('Finished!')
+
+
+def report_timings(outfile_path):
+    '''Log the time spent in each stage of the import and write the timings of each file next to the output file'''
+    for line in import_report_summary():
+        logging.info(line)
+    report_path = write_import_report(outfile_path)
+    logging.info('Timings of each file written to %s.csv/.json', report_path)
+
+
+def relay_output(process, shard_index):
+    '''Copy each line printed by a shard to the log'''
+    for line in process.stdout:
+        line = line.rstrip()
+        if line:
+            logging.info('[shard %s] %s', shard_index, line)
+
+def process_input(folder_path, n_workers=1, checkpoint_path=None, checkpoint_every=0, subfolders=None, min_faces=0, pack=False, mesh_files=None):
+    '''Import all the files of the folder (or of the given subfolders only), one collection per subfolder.
+    mesh_files is the result of the scan of the folder when already done'''
+    # Scan the folder once: (subfolder, file path, size, modification time) of each file with the right extension
+    if mesh_files is None:
+        mesh_files = scan_mesh_files(bpy.path.abspath(folder_path), g_allowed_extension)
+    # Only keep the requested subfolders (shard)
+    if subfolders is not None:
+        mesh_files = [f for f in mesh_files if f[0] in subfolders]
+    total_n_files = len(mesh_files)
+    # Skip the files already imported (when resuming)
+    manifest = load_import_manifest(bpy.context.scene)
+    file_paths = set(files_to_import(mesh_files, manifest))
+    if len(file_paths) < total_n_files:
+        logging.info('%s files already imported, %s left to import', total_n_files - len(file_paths), len(file_paths))
+    mesh_files = [f for f in mesh_files if f[1] in file_paths]
+    # Read the headers of the files left only: skip the debris and import the largest files of each subfolder first
+    mesh_files, n_files_skipped = prescan_mesh_files(mesh_files, min_faces)
+    if n_files_skipped > 0:
+        logging.info('%s files with less than %s faces skipped', n_files_skipped, min_faces)
     # Initialise logging
-    logging.info('Starting. Will import a total of %s files', total_n_files_to_import)
-    # Convert folder_path to a Path object
-    folder_path = Path(folder_path)
-    # Set to store processed subfolders
-    processed_subfolders = set()
-    # Traverse through the folder and its subfolders
-    for file_path in sorted(folder_path.glob('**/*')):
-        # Check if the file extension is in the specified list of extensions
+    logging.info('Starting. Will import a total of %s files (%.0f MB)', len(mesh_files), sum(f[2] for f in mesh_files) / 1e6)
+    # Progress is measured in bytes: the time to import a file grows with its size
+    n_files_per_subfolder = {}
+    for subfolder, *_ in mesh_files:
+        n_files_per_subfolder[subfolder] = n_files_per_subfolder.get(subfolder, 0) + 1
+    total_n_bytes = max(sum(f[2] for f in mesh_files), 1)
+    n_bytes_imported = 0
+    n_files_imported = 0
+    current_subfolder = None
+    # Files are read in parallel by the workers, objects are created here (in the order of mesh_files)
+    for (subfolder, _, size, mtime), (file_path, arrays) in zip(mesh_files, iter_mesh_files([f[1] for f in mesh_files], n_workers)):
+        if subfolder != current_subfolder:
+            # Time point complete: one mesh for all its cells
+            if pack and current_subfolder is not None:
+                pack_collection(coll)
+            logging.info(f"Processing subfolder: {subfolder} - {n_files_per_subfolder[subfolder]} files - Progress: {round(100 * n_bytes_imported / total_n_bytes)}%")
+            current_subfolder = subfolder
+        file_path = Path(file_path)
         folder_name = file_path.parent.name
-        if file_path.suffix.upper() in g_allowed_extension:
-            # Check if the parent folder name is already present in collection
-            if folder_name not in bpy.data.collections:
-                coll = bpy.data.collections.new(name=folder_name)
-                bpy.context.scene.collection.children.link(coll)
-            else:
-                coll = bpy.data.collections[folder_name]
-            import_process_assign(inFilePath=file_path.as_posix(), inColl=coll)
-            # Add the parent folder to the set of processed subfolders if it hasn't been added yet (process new folder)
-            if folder_name not in processed_subfolders:
-                #Retrieve number of files to process in that subfolder
-                local_n_files_to_import = number_of_file_to_import(bpy.path.abspath(file_path.parent.as_posix()), g_allowed_extension,  include_subfolders=False)
-                progress = progress + local_n_files_to_import
-                logging.info(f"Processing subfolder: {folder_name} - {local_n_files_to_import} files - Progress: {round(100*progress/total_n_files_to_import)}%")
-                processed_subfolders.add(folder_name)
-
+        # Check if the parent folder name is already present in collection
+        if folder_name not in bpy.data.collections:
+            coll = bpy.data.collections.new(name=folder_name)
+            bpy.context.scene.collection.children.link(coll)
+        else:
+            coll = bpy.data.collections[folder_name]
+        obj = import_process_assign(inFilePath=file_path.as_posix(), inColl=coll, inArrays=arrays)
+        record_import(manifest, file_path.as_posix(), size, mtime, obj)
+        n_files_imported += 1
+        n_bytes_imported += size
+        # Save regularly so that a crash does not mean starting over
+        if checkpoint_path is not None and checkpoint_every > 0 and n_files_imported % checkpoint_every == 0:
+            save_import_manifest(bpy.context.scene, manifest)
+            save_digest_index()
+            bpy.ops.wm.save_as_mainfile(filepath=checkpoint_path.as_posix(), copy=True)
+            logging.info('Checkpoint: %s files imported (%s%%), saved to %s', n_files_imported, round(100 * n_bytes_imported / total_n_bytes), checkpoint_path)
+    if pack and current_subfolder is not None:
+        pack_collection(coll)
+    save_import_manifest(bpy.context.scene, manifest)
+    save_digest_index()
 
 
 def cleanup():
@@ -92,11 +332,12 @@ def cleanup():
                 bpy.data.collections.remove(coll)
 
 
-def merge_data(list_files):
+def merge_data(list_files, link=False):
+    '''Add the collections of each file to the scene. The files are deleted once appended, kept when linked (libraries)'''
     j = 0
     for f in list_files:
         logging.info('Merging data from %s', f)
-        with bpy.data.libraries.load(f) as (data_from, data_to):
+        with bpy.data.libraries.load(f, link=link) as (data_from, data_to):
             data_to.collections = [c for c in data_from.collections if c != g_import_coll_name]
         # link collection to scene collection
         for coll in data_to.collections:
@@ -109,8 +350,9 @@ def merge_data(list_files):
         i = k - j
         j = k
         logging.info('Added %s objects', i)
-        os.remove(f)
-        logging.info('Erased %s', f)
+        if not link:
+            os.remove(f)
+            logging.info('Erased %s', f)
 
 
 if __name__ == '__main__':